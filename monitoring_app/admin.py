@@ -1,4 +1,12 @@
+from datetime import timedelta
+from django.conf import settings
 from django.contrib import admin
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.functional import cached_property
+from . import search
 from .models import User, Patient, Device, HeartRateData
 
 @admin.register(User)
@@ -19,8 +27,100 @@ class DeviceAdmin(admin.ModelAdmin):
     list_filter = ('status',)
     search_fields = ('device_id', 'patient__user__username')
 
+class EstimatedCountPaginator(Paginator):
+    """
+    Paginator for very large tables. The unfiltered count comes from the
+    database statistics; filtered counts stop at ADMIN_COUNT_LIMIT rows.
+    """
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        if not queryset.query.where:
+            estimate = estimate_row_count(queryset.model, queryset.db)
+            if estimate is not None:
+                return estimate
+        limit = getattr(settings, 'ADMIN_COUNT_LIMIT', 10000)
+        return queryset.order_by()[:limit].count()
+
+
+def estimate_row_count(model, using):
+    table = model._meta.db_table
+    connection = connections[using]
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute('SELECT reltuples::bigint FROM pg_class WHERE relname = %s', [table])
+            row = cursor.fetchone()
+            # reltuples is -1 until the table has been vacuumed or analyzed.
+            return row[0] if row and row[0] >= 0 else None
+        if connection.vendor == 'sqlite':
+            # Rowids grow with every insert, so MAX(rowid) is a one-seek upper bound.
+            cursor.execute('SELECT MAX(rowid) FROM %s' % connection.ops.quote_name(table))
+            return cursor.fetchone()[0] or 0
+    return None
+
+
+class RecordedAtRangeFilter(admin.SimpleListFilter):
+    """Relative date ranges that the recorded_at index can answer."""
+    title = 'recorded at'
+    parameter_name = 'recorded_within'
+    ranges = {
+        '1h': timedelta(hours=1),
+        '24h': timedelta(days=1),
+        '7d': timedelta(days=7),
+        '30d': timedelta(days=30),
+    }
+
+    def lookups(self, request, model_admin):
+        return (
+            ('1h', 'Past hour'),
+            ('24h', 'Past 24 hours'),
+            ('7d', 'Past 7 days'),
+            ('30d', 'Past 30 days'),
+        )
+
+    def queryset(self, request, queryset):
+        delta = self.ranges.get(self.value())
+        if delta is None:
+            return queryset
+        return queryset.filter(recorded_at__gte=timezone.now() - delta)
+
+
+class LargeTableAdminMixin:
+    """
+    ModelAdmin settings for tables with hundreds of millions of rows: no exact
+    counts, related objects joined or entered by id, and a bounded search.
+    Subclasses provide ``get_search_q(term)`` to answer searches from indexed
+    lookups only.
+    """
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    search_term_max_length = 64
+
+    def get_search_results(self, request, queryset, search_term):
+        search_term = search_term.strip()[:self.search_term_max_length]
+        if not search_term:
+            return queryset, False
+        return queryset.filter(self.get_search_q(search_term)), False
+
+
 @admin.register(HeartRateData)
-class HeartRateDataAdmin(admin.ModelAdmin):
+class HeartRateDataAdmin(LargeTableAdminMixin, admin.ModelAdmin):
     list_display = ('patient', 'device', 'heart_rate', 'recorded_at')
-    list_filter = ('recorded_at',)
-    search_fields = ('patient__user__username', 'device__device_id')
\ No newline at end of file
+    list_select_related = ('patient', 'device')
+    list_filter = (RecordedAtRangeFilter,)
+    raw_id_fields = ('patient', 'device')
+    search_fields = ('patient__user__username', 'device__device_id')
+    search_help_text = 'Exact device ID, or the start of a patient name or username.'
+    search_patient_limit = 100
+
+    def get_search_q(self, search_term):
+        # Resolve both sides to ids first so the changelist query ORs two
+        # indexed foreign key lookups instead of joining devices.
+        device_ids = list(Device.objects.filter(device_id=search_term).values_list('pk', flat=True))
+        terms = search.tokenize(search_term)
+        patient_ids = []
+        if terms:
+            patients = search.filter_by_tokens(Patient.objects.all(), 'search_tokens', terms)
+            patient_ids = list(patients.values_list('pk', flat=True)[:self.search_patient_limit])
+        return Q(device__in=device_ids) | Q(patient__in=patient_ids)
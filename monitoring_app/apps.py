@@ -2,4 +2,7 @@ from django.apps import AppConfig
 
 class MonitoringAppConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
-    name = 'monitoring_app'
\ No newline at end of file
+    name = 'monitoring_app'
+
+    def ready(self):
+        from . import checks, signals  # noqa: F401
@@ -0,0 +1,25 @@
+from django.conf import settings
+from django.core.checks import Tags, Warning, register
+
+# Backends whose entries live in a single process.
+PROCESS_LOCAL_CACHES = (
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.dummy.DummyCache',
+)
+
+
+@register(Tags.caches, Tags.database)
+def check_primary_pin_cache(app_configs, **kwargs):
+    """With replicas, the read-your-writes pin only works if all workers share its cache."""
+    if not getattr(settings, 'DATABASE_READ_REPLICAS', []):
+        return []
+    alias = getattr(settings, 'PRIMARY_PIN_CACHE', 'default')
+    backend = settings.CACHES.get(alias, {}).get('BACKEND')
+    if backend in PROCESS_LOCAL_CACHES:
+        return [Warning(
+            'PRIMARY_PIN_CACHE %r uses %s, which is not shared between processes.' % (alias, backend),
+            hint='Point it at a shared cache such as Redis (CACHE_URL), or clients may '
+                 'read stale data from a replica right after a write.',
+            id='monitoring_app.W001',
+        )]
+    return []
@@ -0,0 +1,153 @@
+from collections import defaultdict
+from datetime import timedelta
+from itertools import groupby
+
+from django.conf import settings
+from django.db import transaction
+from django.utils.dateparse import parse_datetime
+
+from .models import Device, DeviceCoverageInterval, HeartRateData
+
+
+def max_gap():
+    """Readings further apart than this start a new coverage interval."""
+    return timedelta(seconds=getattr(settings, 'COVERAGE_MAX_GAP_SECONDS', 300))
+
+
+def collapse(timestamps, gap):
+    """Merge sorted timestamps into [start, end] runs with no step over ``gap``."""
+    runs = []
+    for timestamp in timestamps:
+        if runs and timestamp - runs[-1][1] <= gap:
+            runs[-1][1] = max(runs[-1][1], timestamp)
+        else:
+            runs.append([timestamp, timestamp])
+    return runs
+
+
+def merge(existing, runs, gap):
+    """
+    Join stored intervals and new [start, end] runs that are within ``gap`` of
+    each other. Returns (start, end, stored intervals absorbed) per result.
+    """
+    items = sorted([(i.start, i.end, i) for i in existing] + [(start, end, None) for start, end in runs],
+                   key=lambda item: item[0])
+    merged = []
+    for start, end, interval in items:
+        if merged and start - merged[-1][1] <= gap:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end, []])
+        if interval is not None:
+            merged[-1][2].append(interval)
+    return merged
+
+
+def record_readings(readings):
+    """
+    Update the coverage index for an iterable of (device_id, patient_id,
+    recorded_at). The batch is collapsed into runs locally, merged in memory
+    with the stored intervals it touches, and written back with one query per
+    kind of change, however many devices and runs it spans.
+    """
+    gap = max_gap()
+    by_key = defaultdict(list)
+    for device_id, patient_id, recorded_at in readings:
+        if isinstance(recorded_at, str):
+            recorded_at = parse_datetime(recorded_at)
+        by_key[device_id, patient_id].append(recorded_at)
+    if not by_key:
+        return
+    runs = {key: collapse(sorted(timestamps), gap) for key, timestamps in by_key.items()}
+    first = min(key_runs[0][0] for key_runs in runs.values())
+    last = max(key_runs[-1][1] for key_runs in runs.values())
+
+    created, updated, deleted = [], [], []
+    with transaction.atomic():
+        existing = defaultdict(list)
+        nearby = DeviceCoverageInterval.objects.select_for_update().filter(
+            device_id__in={device_id for device_id, _ in runs},
+            end__gte=first - gap, start__lte=last + gap,
+        )
+        for interval in nearby:
+            if (interval.device_id, interval.patient_id) in runs:
+                existing[interval.device_id, interval.patient_id].append(interval)
+        for (device_id, patient_id), key_runs in runs.items():
+            for start, end, absorbed in merge(existing[device_id, patient_id], key_runs, gap):
+                if not absorbed:
+                    created.append(DeviceCoverageInterval(
+                        device_id=device_id, patient_id=patient_id, start=start, end=end))
+                    continue
+                interval = absorbed[0]
+                deleted.extend(other.pk for other in absorbed[1:])
+                if (interval.start, interval.end) != (start, end):
+                    interval.start, interval.end = start, end
+                    updated.append(interval)
+        if deleted:
+            DeviceCoverageInterval.objects.filter(pk__in=deleted).delete()
+        if updated:
+            DeviceCoverageInterval.objects.bulk_update(updated, ['start', 'end'])
+        if created:
+            DeviceCoverageInterval.objects.bulk_create(created)
+
+
+def rebuild_index(batch_size=1000, device_chunk_size=100, progress=None):
+    """
+    Recompute the index from heart_rate_data, one chunk of devices per
+    transaction. ``progress`` is called with the percentage done after each
+    chunk.
+    """
+    gap = max_gap()
+    device_ids = list(Device.objects.order_by('pk').values_list('pk', flat=True))
+    for done in range(0, len(device_ids), device_chunk_size):
+        chunk = device_ids[done:done + device_chunk_size]
+        readings = (HeartRateData.objects.filter(device__in=chunk).order_by('device', 'patient', 'recorded_at')
+                    .values_list('device', 'patient', 'recorded_at').iterator(chunk_size=10000))
+        with transaction.atomic():
+            DeviceCoverageInterval.objects.filter(device__in=chunk).delete()
+            batch = []
+            for (device_id, patient_id), group in groupby(readings, key=lambda row: row[:2]):
+                for start, end in collapse((row[2] for row in group), gap):
+                    batch.append(DeviceCoverageInterval(
+                        device_id=device_id, patient_id=patient_id, start=start, end=end))
+                    if len(batch) >= batch_size:
+                        DeviceCoverageInterval.objects.bulk_create(batch)
+                        batch = []
+            DeviceCoverageInterval.objects.bulk_create(batch)
+        if progress is not None:
+            progress(100 * (done + len(chunk)) / len(device_ids))
+
+
+def intervals_by(field, ids, start, end):
+    """{id: [[start, end], ...]} of merged intervals overlapping the window, clipped to it."""
+    intervals = defaultdict(list)
+    queryset = (DeviceCoverageInterval.objects
+                .filter(**{field + '__in': ids}, end__gte=start, start__lte=end)
+                .order_by(field, 'start')
+                .values_list(field, 'start', 'end'))
+    for key, interval_start, interval_end in queryset:
+        interval_start, interval_end = max(interval_start, start), min(interval_end, end)
+        merged = intervals[key]
+        if merged and interval_start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], interval_end)
+        else:
+            merged.append([interval_start, interval_end])
+    return intervals
+
+
+def coverage(intervals, start, end):
+    """Covered seconds and percentage of the window for merged, clipped intervals."""
+    covered = sum((interval_end - interval_start).total_seconds() for interval_start, interval_end in intervals)
+    window = (end - start).total_seconds()
+    return covered, round(100 * covered / window, 2) if window else 0
+
+
+def gaps(intervals, start, end, min_gap):
+    """Uncovered stretches of the window that are at least ``min_gap`` long."""
+    found = []
+    cursor = start
+    for interval_start, interval_end in intervals + [[end, end]]:
+        if interval_start - cursor >= min_gap:
+            found.append((cursor, interval_start))
+        cursor = max(cursor, interval_end)
+    return found
@@ -0,0 +1,168 @@
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import django
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.tokens import default_token_generator
+from django.db import IntegrityError, transaction
+from django.utils.encoding import force_bytes
+from django.utils.http import urlsafe_base64_encode
+
+from . import search
+from .models import User, Patient, Device
+from .serializers import PatientEnrollmentSerializer
+
+PATIENT_FIELDS = ('date_of_birth', 'gender', 'address', 'emergency_contact', 'medical_history')
+LOOKUP_CHUNK_SIZE = 500
+# Inserts retried after a concurrent batch takes a username or device id.
+INSERT_ATTEMPTS = 2
+
+
+def hash_passwords(passwords):
+    """
+    Hash ``passwords`` in order; None gives an unusable password. Large batches
+    are spread over a process pool since every hash is deliberately slow.
+    """
+    workers = getattr(settings, 'ENROLLMENT_HASH_WORKERS', os.cpu_count() or 1)
+    threshold = getattr(settings, 'ENROLLMENT_POOL_THRESHOLD', 16)
+    hashed = [make_password(None) if password is None else None for password in passwords]
+    todo = [(i, password) for i, password in enumerate(passwords) if password is not None]
+    if workers > 1 and len(todo) >= threshold:
+        # Spawn rather than fork: forking a threaded server process can copy
+        # held locks and open database connections into the children.
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=django.setup) as executor:
+            results = executor.map(make_password, [password for _, password in todo],
+                                   chunksize=max(1, len(todo) // (workers * 4)))
+            for (i, _), result in zip(todo, results):
+                hashed[i] = result
+    else:
+        for i, password in todo:
+            hashed[i] = make_password(password)
+    return hashed
+
+
+def _existing(queryset, field, values):
+    found = set()
+    values = list(values)
+    for start in range(0, len(values), LOOKUP_CHUNK_SIZE):
+        chunk = values[start:start + LOOKUP_CHUNK_SIZE]
+        found.update(queryset.filter(**{field + '__in': chunk}).values_list(field, flat=True))
+    return found
+
+
+def _fill_pks(objs, model, field):
+    """Backends that can't return ids from a bulk insert leave pk unset."""
+    if objs and objs[0].pk is None:
+        keys = [getattr(obj, field) for obj in objs]
+        ids = dict(model.objects.filter(**{field + '__in': keys}).values_list(field, 'pk'))
+        for obj, key in zip(objs, keys):
+            obj.pk = ids[key]
+
+
+def validate_rows(rows):
+    """Return ({row: validated data}, {row: errors}) for a batch of rows."""
+    valid, errors = {}, {}
+    for index, row in enumerate(rows):
+        serializer = PatientEnrollmentSerializer(data=row)
+        if serializer.is_valid():
+            valid[index] = serializer.validated_data
+        else:
+            errors[index] = serializer.errors
+
+    taken = {
+        'username': _existing(User.objects, 'username', {data['username'] for data in valid.values()}),
+        'device_id': _existing(Device.objects, 'device_id',
+                               {data['device_id'] for data in valid.values() if 'device_id' in data}),
+    }
+    seen = {'username': set(), 'device_id': set()}
+    for index, data in list(valid.items()):
+        row_errors = {}
+        for field in ('username', 'device_id'):
+            value = data.get(field)
+            if value is None:
+                continue
+            if value in taken[field]:
+                row_errors[field] = ['%s already exists.' % value]
+            elif value in seen[field]:
+                row_errors[field] = ['%s appears more than once in this batch.' % value]
+            seen[field].add(value)
+        if row_errors:
+            errors[index] = row_errors
+            del valid[index]
+    return valid, errors
+
+
+def _insert(valid, indexes, passwords):
+    with transaction.atomic():
+        users = User.objects.bulk_create([
+            User(
+                username=valid[i]['username'],
+                email=valid[i]['email'],
+                first_name=valid[i]['first_name'],
+                last_name=valid[i]['last_name'],
+                phone_number=valid[i]['phone_number'],
+                password=passwords[i],
+                user_type='patient',
+            )
+            for i in indexes
+        ])
+        _fill_pks(users, User, 'username')
+
+        patients = Patient.objects.bulk_create([
+            Patient(user=user, **{field: valid[i].get(field) for field in PATIENT_FIELDS if field in valid[i]})
+            for i, user in zip(indexes, users)
+        ])
+        _fill_pks(patients, Patient, 'user_id')
+
+        devices = Device.objects.bulk_create([
+            Device(device_id=valid[i]['device_id'], patient=patient)
+            for i, patient in zip(indexes, patients)
+            if 'device_id' in valid[i]
+        ])
+        _fill_pks(devices, Device, 'device_id')
+        search.index_patients(patients)
+        search.index_devices(devices)
+    return users, patients
+
+
+def enroll_patients(rows):
+    """
+    Create a user, patient and (optionally) device for each valid row in one
+    transaction. Rows without a password get an unusable one and an invite
+    token to set it. Returns (created, errors) lists keyed by row index.
+    """
+    valid, errors = validate_rows(rows)
+    passwords = {}
+    for attempt in range(1, INSERT_ATTEMPTS + 1):
+        indexes = sorted(valid)
+        todo = [i for i in indexes if i not in passwords]
+        passwords.update(zip(todo, hash_passwords([valid[i].get('password') for i in todo])))
+        try:
+            users, patients = _insert(valid, indexes, passwords)
+            break
+        except IntegrityError:
+            if attempt == INSERT_ATTEMPTS:
+                raise
+            # Another batch committed some of these usernames or device ids
+            # since they were checked; validate again to report those rows.
+            valid, errors = validate_rows(rows)
+
+    created = []
+    for i, user, patient in zip(indexes, users, patients):
+        entry = {
+            'row': i,
+            'user_id': user.pk,
+            'patient_id': patient.pk,
+            'username': user.username,
+            'device_id': valid[i].get('device_id'),
+        }
+        if not user.has_usable_password():
+            entry['invite'] = {
+                'uid': urlsafe_base64_encode(force_bytes(user.pk)),
+                'token': default_token_generator.make_token(user),
+            }
+        created.append(entry)
+    return created, [{'row': i, 'errors': errors[i]} for i in sorted(errors)]
@@ -0,0 +1,263 @@
+import csv
+import hashlib
+import json
+import multiprocessing
+import os
+import time
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from datetime import timezone as dt_timezone
+
+import django
+from django.core.management.base import BaseCommand, CommandError
+from django.core.validators import MaxValueValidator, MinValueValidator
+from django.db import connection, transaction
+from django.utils.dateparse import parse_datetime
+
+from monitoring_app import coverage
+from monitoring_app.models import Device, HeartRateData, ImportCheckpoint
+
+FORMATS = {'.csv': 'csv', '.ndjson': 'ndjson', '.jsonl': 'ndjson', '.json': 'ndjson'}
+MAX_REPORTED_ERRORS = 20
+FINGERPRINT_HEAD = 64 * 1024
+FINGERPRINT_TAIL = 4 * 1024
+
+
+def fingerprint(path, offset):
+    """
+    Hash the start of the file and the bytes just before ``offset``. Both are
+    already imported, so appending to the file keeps the fingerprint while
+    replacing or rewriting it does not.
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        digest.update(f.read(min(offset, FINGERPRINT_HEAD)))
+        tail_start = max(0, offset - FINGERPRINT_TAIL)
+        f.seek(tail_start)
+        digest.update(f.read(offset - tail_start))
+    return digest.hexdigest()
+
+
+def heart_rate_bounds():
+    validators = HeartRateData._meta.get_field('heart_rate').validators
+    low = next(v.limit_value for v in validators if isinstance(v, MinValueValidator))
+    high = next(v.limit_value for v in validators if isinstance(v, MaxValueValidator))
+    return low, high
+
+
+def parse_record(record, bounds):
+    device_id = str(record.get('device_id') or '').strip()
+    if not device_id:
+        raise ValueError('missing device_id')
+    try:
+        heart_rate = int(record.get('heart_rate'))
+    except (TypeError, ValueError):
+        raise ValueError('invalid heart_rate %r' % record.get('heart_rate'))
+    if not bounds[0] <= heart_rate <= bounds[1]:
+        raise ValueError('heart_rate %d outside %d-%d' % (heart_rate, bounds[0], bounds[1]))
+    recorded_at = parse_datetime(str(record.get('recorded_at') or ''))
+    if recorded_at is None:
+        raise ValueError('invalid recorded_at %r' % record.get('recorded_at'))
+    if recorded_at.tzinfo is None:
+        recorded_at = recorded_at.replace(tzinfo=dt_timezone.utc)
+    return device_id, heart_rate, recorded_at
+
+
+def parse_chunk(fmt, header, first_line, lines, bounds):
+    """
+    Parse and validate raw lines into (line, device_id, heart_rate,
+    recorded_at) rows. Runs in a worker process, so device lookups happen in
+    the parent.
+    """
+    rows, errors = [], []
+    for line_no, line in enumerate(lines, start=first_line):
+        try:
+            text = line.decode('utf-8').strip()
+            if not text:
+                continue
+            if fmt == 'csv':
+                record = dict(zip(header, next(csv.reader([text]))))
+            else:
+                record = json.loads(text)
+                if not isinstance(record, dict):
+                    raise ValueError('expected a JSON object')
+            rows.append((line_no,) + parse_record(record, bounds))
+        except (ValueError, csv.Error) as exc:
+            errors.append((line_no, str(exc)))
+    return rows, errors
+
+
+class InlineExecutor:
+    """Stands in for the process pool when --workers 0."""
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def submit(self, fn, *args):
+        future = Future()
+        future.set_result(fn(*args))
+        return future
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+class Command(BaseCommand):
+    help = (
+        'Bulk import historical heart rate readings from CSV or NDJSON files '
+        '(device_id, heart_rate, recorded_at). Imports are resumable: progress '
+        'is checkpointed per file after every committed chunk.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('paths', nargs='+')
+        parser.add_argument('--format', choices=['csv', 'ndjson'],
+                            help='Input format; guessed from the file extension by default.')
+        parser.add_argument('--chunk-size', type=int, default=20000,
+                            help='Lines parsed and committed together.')
+        parser.add_argument('--batch-size', type=int, default=5000,
+                            help='Rows per INSERT statement.')
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                            help='Parser processes; 0 parses in this process.')
+        parser.add_argument('--drop-indexes', action='store_true',
+                            help='Drop the heart rate indexes during the import and rebuild them after.')
+        parser.add_argument('--restart', action='store_true',
+                            help='Ignore any checkpoint and import each file from the start.')
+
+    def handle(self, *args, **options):
+        for path in options['paths']:
+            if not os.path.isfile(path):
+                raise CommandError('File not found: %s' % path)
+
+        self.devices = {
+            device_id: (pk, patient_id)
+            for device_id, pk, patient_id in Device.objects.values_list('device_id', 'pk', 'patient_id').iterator()
+        }
+        self.bounds = heart_rate_bounds()
+        self.options = options
+
+        indexes = list(HeartRateData._meta.indexes) if options['drop_indexes'] else []
+        self.alter_indexes('remove_index', indexes)
+        try:
+            for path in options['paths']:
+                self.import_file(path)
+        finally:
+            if indexes:
+                self.stdout.write('Rebuilding indexes...')
+            self.alter_indexes('add_index', indexes)
+
+    def alter_indexes(self, method, indexes):
+        if not indexes:
+            return
+        with connection.schema_editor() as editor:
+            for index in indexes:
+                getattr(editor, method)(HeartRateData, index)
+
+    def import_file(self, path):
+        fmt = self.options['format'] or FORMATS.get(os.path.splitext(path)[1].lower())
+        if fmt is None:
+            raise CommandError('Cannot tell the format of %s; pass --format.' % path)
+
+        checkpoint, _ = ImportCheckpoint.objects.get_or_create(source=os.path.abspath(path))
+        if self.options['restart']:
+            checkpoint.offset = checkpoint.line = checkpoint.rows_imported = checkpoint.rows_rejected = 0
+            checkpoint.fingerprint = ''
+            checkpoint.save()
+        elif checkpoint.offset:
+            if (os.path.getsize(path) < checkpoint.offset
+                    or checkpoint.fingerprint and checkpoint.fingerprint != fingerprint(path, checkpoint.offset)):
+                raise CommandError(
+                    '%s has changed since it was imported up to line %d; pass --restart to import it from the '
+                    'start.' % (path, checkpoint.line))
+            self.stdout.write('Resuming %s at line %d' % (path, checkpoint.line + 1))
+        self.path = path
+
+        self.started = self.last_report = time.monotonic()
+        self.session_rows = 0
+        self.reported_errors = 0
+        workers = self.options['workers']
+        executor_class = ProcessPoolExecutor if workers > 0 else InlineExecutor
+        pending = deque()
+        context = multiprocessing.get_context('spawn')
+        with open(path, 'rb') as source, executor_class(
+                max_workers=workers, mp_context=context, initializer=django.setup) as executor:
+            header = self.read_header(source, checkpoint) if fmt == 'csv' else None
+            for first_line, lines, end_offset in self.read_chunks(source, checkpoint):
+                future = executor.submit(parse_chunk, fmt, header, first_line, lines, self.bounds)
+                pending.append((future, first_line + len(lines) - 1, end_offset))
+                # Bound the number of chunks in memory, and commit them in file order
+                # so the checkpoint only ever moves forward.
+                if len(pending) > 2 * max(workers, 1):
+                    self.write_chunk(checkpoint, *pending.popleft())
+            while pending:
+                self.write_chunk(checkpoint, *pending.popleft())
+
+        elapsed = time.monotonic() - self.started
+        self.stdout.write(self.style.SUCCESS(
+            '%s: %d rows imported, %d rejected in total; %d rows in %.1fs (%.0f rows/s)' % (
+                path, checkpoint.rows_imported, checkpoint.rows_rejected,
+                self.session_rows, elapsed, self.session_rows / elapsed if elapsed else 0)))
+
+    def read_header(self, source, checkpoint):
+        header_line = source.readline()
+        header = [name.strip() for name in next(csv.reader([header_line.decode('utf-8-sig')]), [])]
+        missing = {'device_id', 'heart_rate', 'recorded_at'} - set(header)
+        if missing:
+            raise CommandError('CSV header is missing: %s' % ', '.join(sorted(missing)))
+        if not checkpoint.offset:
+            checkpoint.offset, checkpoint.line = source.tell(), 1
+        return header
+
+    def read_chunks(self, source, checkpoint):
+        """Yield (first line number, raw lines, byte offset after the chunk)."""
+        chunk_size = self.options['chunk_size']
+        source.seek(checkpoint.offset)
+        offset, line = checkpoint.offset, checkpoint.line
+        while True:
+            lines = []
+            for raw in source:
+                lines.append(raw)
+                offset += len(raw)
+                if len(lines) == chunk_size:
+                    break
+            if not lines:
+                return
+            yield line + 1, lines, offset
+            line += len(lines)
+
+    def write_chunk(self, checkpoint, future, last_line, end_offset):
+        rows, errors = future.result()
+        objects = []
+        for line_no, device_id, heart_rate, recorded_at in rows:
+            device = self.devices.get(device_id)
+            if device is None:
+                errors.append((line_no, 'unknown device_id %r' % device_id))
+                continue
+            objects.append(HeartRateData(device_id=device[0], patient_id=device[1],
+                                         heart_rate=heart_rate, recorded_at=recorded_at))
+
+        with transaction.atomic():
+            HeartRateData.objects.bulk_create(objects, batch_size=self.options['batch_size'])
+            coverage.record_readings((obj.device_id, obj.patient_id, obj.recorded_at) for obj in objects)
+            checkpoint.offset, checkpoint.line = end_offset, last_line
+            checkpoint.fingerprint = fingerprint(self.path, end_offset)
+            checkpoint.rows_imported += len(objects)
+            checkpoint.rows_rejected += len(errors)
+            checkpoint.save()
+        self.session_rows += len(objects)
+
+        for line_no, message in sorted(errors):
+            if self.reported_errors < MAX_REPORTED_ERRORS:
+                self.stderr.write('line %d: %s' % (line_no, message))
+            elif self.reported_errors == MAX_REPORTED_ERRORS:
+                self.stderr.write('further errors are counted but not shown')
+            self.reported_errors += 1
+
+        now = time.monotonic()
+        if now - self.last_report >= 5:
+            self.last_report = now
+            self.stdout.write('line %d: %d rows imported (%.0f rows/s)' % (
+                last_line, checkpoint.rows_imported, self.session_rows / (now - self.started)))
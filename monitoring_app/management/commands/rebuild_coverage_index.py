@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from monitoring_app import coverage
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the device coverage interval index from all heart rate readings.'
+
+    def handle(self, *args, **options):
+        coverage.rebuild_index()
+        self.stdout.write(self.style.SUCCESS('Coverage index rebuilt.'))
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from monitoring_app import search
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the patient and device search token index.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        search.rebuild_index(chunk_size=options['chunk_size'])
+        self.stdout.write(self.style.SUCCESS('Search index rebuilt.'))
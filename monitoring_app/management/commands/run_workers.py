@@ -0,0 +1,90 @@
+import multiprocessing
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+
+import django
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from monitoring_app import tasks
+from monitoring_app.models import Task
+
+
+class Command(BaseCommand):
+    help = 'Run queued background tasks in a pool of worker processes.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int,
+                            default=getattr(settings, 'TASK_WORKERS', os.cpu_count() or 1),
+                            help='Tasks run at the same time; 0 runs them one by one in this process.')
+        parser.add_argument('--poll-interval', type=float, default=1.0,
+                            help='Seconds to wait when the queue is empty.')
+        parser.add_argument('--once', action='store_true',
+                            help='Exit once no tasks are due and none are running.')
+
+    def handle(self, *args, **options):
+        if options['processes'] == 0:
+            self.run_inline(options)
+        else:
+            self.run_pool(options)
+
+    def run_inline(self, options):
+        while True:
+            task_id = tasks.claim_next()
+            if task_id is None:
+                if options['once']:
+                    return
+                time.sleep(options['poll_interval'])
+                continue
+            self.stdout.write('Running task %d' % task_id)
+            tasks.execute(task_id)
+
+    def run_pool(self, options):
+        processes = options['processes']
+        running = {}
+        executor = self.start_pool(processes)
+        self.stdout.write('Started %d worker processes' % processes)
+        renew_every = getattr(settings, 'TASK_LEASE_SECONDS', 300) / 3
+        renewed = time.monotonic()
+        try:
+            while True:
+                if running and time.monotonic() - renewed >= renew_every:
+                    tasks.renew_leases([task_id for task_id, _ in running.values()])
+                    renewed = time.monotonic()
+
+                broken = False
+                for future in [future for future in running if future.done()]:
+                    task_id, attempt = running.pop(future)
+                    error = future.exception()
+                    if error is not None:
+                        tasks.fail(task_id, 'Worker process failed: %r' % error, attempt)
+                        broken = broken or isinstance(error, BrokenProcessPool)
+                if broken:
+                    executor.shutdown(wait=False)
+                    executor = self.start_pool(processes)
+
+                # Only claim as many tasks as there are free processes.
+                while len(running) < processes:
+                    task_id = tasks.claim_next()
+                    if task_id is None:
+                        break
+                    self.stdout.write('Running task %d' % task_id)
+                    attempt = Task.objects.values_list('attempts', flat=True).get(pk=task_id)
+                    running[executor.submit(tasks.execute, task_id)] = (task_id, attempt)
+
+                if running:
+                    wait(running, timeout=options['poll_interval'], return_when=FIRST_COMPLETED)
+                elif options['once']:
+                    return
+                else:
+                    time.sleep(options['poll_interval'])
+        finally:
+            executor.shutdown(wait=True)
+
+    def start_pool(self, processes):
+        # Spawned rather than forked, so workers never inherit this process's
+        # open database connections.
+        return ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context('spawn'),
+                                   initializer=django.setup)
@@ -0,0 +1,75 @@
+# Generated by Django 4.2 on 2026-10-19 10:48
+
+from itertools import islice
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+from monitoring_app.search import tokenize
+
+
+def _bulk_create_in_chunks(model, objs, chunk_size=1000):
+    objs = iter(objs)
+    while True:
+        chunk = list(islice(objs, chunk_size))
+        if not chunk:
+            break
+        model.objects.bulk_create(chunk)
+
+
+def build_search_tokens(apps, schema_editor):
+    Patient = apps.get_model('monitoring_app', 'Patient')
+    Device = apps.get_model('monitoring_app', 'Device')
+    PatientSearchToken = apps.get_model('monitoring_app', 'PatientSearchToken')
+    DeviceSearchToken = apps.get_model('monitoring_app', 'DeviceSearchToken')
+    _bulk_create_in_chunks(PatientSearchToken, (
+        PatientSearchToken(patient_id=patient.pk, token=token)
+        for patient in Patient.objects.select_related('user').iterator()
+        for token in tokenize(patient.user.username, patient.user.first_name, patient.user.last_name)
+    ))
+    _bulk_create_in_chunks(DeviceSearchToken, (
+        DeviceSearchToken(device_id=device.pk, token=token)
+        for device in Device.objects.select_related('patient__user').iterator()
+        for token in tokenize(device.device_id, device.patient.user.username)
+    ))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('monitoring_app', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PatientSearchToken',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('token', models.CharField(max_length=64)),
+                ('patient', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='search_tokens', to='monitoring_app.patient')),
+            ],
+            options={
+                'db_table': 'patient_search_tokens',
+            },
+        ),
+        migrations.CreateModel(
+            name='DeviceSearchToken',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('token', models.CharField(max_length=64)),
+                ('device', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='search_tokens', to='monitoring_app.device')),
+            ],
+            options={
+                'db_table': 'device_search_tokens',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='patientsearchtoken',
+            index=models.Index(fields=['token', 'patient'], name='patient_sea_token_a932f8_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='devicesearchtoken',
+            index=models.Index(fields=['token', 'device'], name='device_sear_token_ca8e78_idx'),
+        ),
+        migrations.RunPython(build_search_tokens, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.2 on 2026-10-19 10:49
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('monitoring_app', '0002_search_tokens'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='heartratedata',
+            index=models.Index(fields=['recorded_at', 'id'], name='heart_rate__recorde_731abc_idx'),
+        ),
+    ]
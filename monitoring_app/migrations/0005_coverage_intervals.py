@@ -0,0 +1,36 @@
+# Generated by Django 4.2 on 2026-10-19 10:58
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('monitoring_app', '0004_import_checkpoints'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DeviceCoverageInterval',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('start', models.DateTimeField()),
+                ('end', models.DateTimeField()),
+                ('device', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='coverage_intervals', to='monitoring_app.device')),
+                ('patient', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='coverage_intervals', to='monitoring_app.patient')),
+            ],
+            options={
+                'db_table': 'device_coverage_intervals',
+                'ordering': ['start'],
+            },
+        ),
+        migrations.AddIndex(
+            model_name='devicecoverageinterval',
+            index=models.Index(fields=['device', 'start'], name='device_cove_device__777418_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='devicecoverageinterval',
+            index=models.Index(fields=['patient', 'start'], name='device_cove_patient_83beaf_idx'),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 4.2 on 2026-10-19 11:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('monitoring_app', '0008_import_checkpoint_fingerprint'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='devicecoverageinterval',
+            name='device_cove_device__777418_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='devicecoverageinterval',
+            name='device_cove_patient_83beaf_idx',
+        ),
+        migrations.AddIndex(
+            model_name='devicecoverageinterval',
+            index=models.Index(fields=['device', 'end'], name='device_cove_device__69b093_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='devicecoverageinterval',
+            index=models.Index(fields=['patient', 'end'], name='device_cove_patient_ccfaf0_idx'),
+        ),
+    ]
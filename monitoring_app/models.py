@@ -1,4 +1,5 @@
 from django.db import models
+from django.utils import timezone
 from django.contrib.auth.models import AbstractUser
 from django.core.validators import MinValueValidator, MaxValueValidator
 
@@ -52,6 +53,26 @@ class Device(models.Model):
     class Meta:
         db_table = 'devices'
 
+class PatientSearchToken(models.Model):
+    patient = models.ForeignKey(Patient, on_delete=models.CASCADE, related_name='search_tokens')
+    token = models.CharField(max_length=64)
+
+    class Meta:
+        db_table = 'patient_search_tokens'
+        indexes = [
+            models.Index(fields=['token', 'patient']),
+        ]
+
+class DeviceSearchToken(models.Model):
+    device = models.ForeignKey(Device, on_delete=models.CASCADE, related_name='search_tokens')
+    token = models.CharField(max_length=64)
+
+    class Meta:
+        db_table = 'device_search_tokens'
+        indexes = [
+            models.Index(fields=['token', 'device']),
+        ]
+
 class HeartRateData(models.Model):
     device = models.ForeignKey(Device, on_delete=models.CASCADE, related_name='heart_rate_data')
     patient = models.ForeignKey(Patient, on_delete=models.CASCADE, related_name='heart_rate_data')
@@ -63,5 +84,70 @@ class HeartRateData(models.Model):
         db_table = 'heart_rate_data'
         indexes = [
             models.Index(fields=['patient', 'recorded_at']),
+            models.Index(fields=['recorded_at', 'id']),
+        ]
+        ordering = ['-recorded_at']
+
+class DeviceCoverageInterval(models.Model):
+    """A stretch of time in which a device reported with no gap over COVERAGE_MAX_GAP_SECONDS."""
+    device = models.ForeignKey(Device, on_delete=models.CASCADE, related_name='coverage_intervals')
+    patient = models.ForeignKey(Patient, on_delete=models.CASCADE, related_name='coverage_intervals')
+    start = models.DateTimeField()
+    end = models.DateTimeField()
+
+    class Meta:
+        db_table = 'device_coverage_intervals'
+        # A device's intervals don't overlap, so ordered by end they are also
+        # ordered by start: an end >= window start range scan begins at the
+        # window instead of at the device's first interval.
+        indexes = [
+            models.Index(fields=['device', 'end']),
+            models.Index(fields=['patient', 'end']),
+        ]
+        ordering = ['start']
+
+class ImportCheckpoint(models.Model):
+    source = models.CharField(max_length=255, unique=True)
+    offset = models.BigIntegerField(default=0)
+    line = models.BigIntegerField(default=0)
+    rows_imported = models.BigIntegerField(default=0)
+    rows_rejected = models.BigIntegerField(default=0)
+    # Hash of the bytes already imported, to notice a different file at the same path.
+    fingerprint = models.CharField(max_length=64, blank=True, default='')
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        db_table = 'import_checkpoints'
+
+class Task(models.Model):
+    STATUS_CHOICES = (
+        ('pending', 'Pending'),
+        ('running', 'Running'),
+        ('succeeded', 'Succeeded'),
+        ('failed', 'Failed'),
+        ('cancelled', 'Cancelled'),
+    )
+
+    name = models.CharField(max_length=100)
+    arguments = models.JSONField(default=dict, blank=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='pending')
+    progress = models.FloatField(default=0)
+    result = models.JSONField(blank=True, null=True)
+    error = models.TextField(blank=True, default='')
+    attempts = models.PositiveIntegerField(default=0)
+    max_retries = models.PositiveIntegerField(default=0)
+    cancel_requested = models.BooleanField(default=False)
+    run_after = models.DateTimeField(default=timezone.now)
+    created_by = models.ForeignKey(User, on_delete=models.SET_NULL, blank=True, null=True, related_name='tasks')
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(blank=True, null=True)
+    finished_at = models.DateTimeField(blank=True, null=True)
+    # A running task whose lease runs out has lost its worker and is reclaimed.
+    claimed_until = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        db_table = 'tasks'
+        indexes = [
+            models.Index(fields=['status', 'run_after']),
         ]
-        ordering = ['-recorded_at']
\ No newline at end of file
+        ordering = ['-created_at']
@@ -0,0 +1,119 @@
+import random
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import DEFAULT_DB_ALIAS, connections
+from rest_framework.permissions import SAFE_METHODS
+
+# Set by ReplicaReadMixin for the duration of a read-only request.
+_replica_reads = ContextVar('replica_reads', default=False)
+
+PIN_KEY_PREFIX = 'primary-pin'
+
+
+def get_replica_aliases():
+    return [alias for alias in getattr(settings, 'DATABASE_READ_REPLICAS', []) if alias in settings.DATABASES]
+
+
+def _pin_cache():
+    return caches[getattr(settings, 'PRIMARY_PIN_CACHE', 'default')]
+
+
+def _pin_key(request):
+    # Prefer the API token so that two clients sharing a user don't pin each other.
+    key = getattr(request.auth, 'key', None)
+    if key is None:
+        if not request.user.is_authenticated:
+            return None
+        key = 'user:%s' % request.user.pk
+    return '%s:%s' % (PIN_KEY_PREFIX, key)
+
+
+def pin_to_primary(request, token=None):
+    """
+    Route this client's reads to the primary until replicas have caught up.
+    Pass ``token`` to pin a client that was only just issued one.
+    """
+    key = _pin_key(request) if token is None else '%s:%s' % (PIN_KEY_PREFIX, token.key)
+    if key is not None:
+        _pin_cache().set(key, True, getattr(settings, 'REPLICATION_LAG_SECONDS', 5))
+
+
+def is_pinned_to_primary(request):
+    key = _pin_key(request)
+    return key is not None and _pin_cache().get(key, False)
+
+
+@contextmanager
+def replica_reads():
+    """Send reads in this block to the replicas, e.g. for read-only background work."""
+    token = _replica_reads.set(True)
+    try:
+        yield
+    finally:
+        _replica_reads.reset(token)
+
+
+class PrimaryReplicaRouter:
+    """
+    Sends writes to the primary and reads to a random replica, but only while
+    a view has opted in through ReplicaReadMixin. Everything else, including
+    reads inside a transaction on the primary, stays on the primary.
+    """
+
+    def db_for_read(self, model, **hints):
+        if not _replica_reads.get():
+            return DEFAULT_DB_ALIAS
+        if connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return DEFAULT_DB_ALIAS
+        replicas = get_replica_aliases()
+        if not replicas:
+            return DEFAULT_DB_ALIAS
+        return random.choice(replicas)
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Replicas hold the same data as the primary.
+        return True
+
+
+class ReplicaReadMixin:
+    """
+    DRF view mixin that serves safe requests from the read replicas.
+
+    Authentication still runs against the primary. Once a client has made a
+    successful write, its reads go to the primary for REPLICATION_LAG_SECONDS
+    so it always sees its own writes. Views that only need the pinning
+    behaviour can set ``replica_reads = False``.
+    """
+    replica_reads = True
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        if (self.replica_reads and request.method in SAFE_METHODS
+                and not is_pinned_to_primary(request)):
+            self._replica_reads_token = _replica_reads.set(True)
+
+    def dispatch(self, request, *args, **kwargs):
+        # finalize_response() is skipped when the view raises an exception DRF
+        # doesn't handle, and the flag must not leak into the thread's next request.
+        try:
+            return super().dispatch(request, *args, **kwargs)
+        finally:
+            self._end_replica_reads()
+
+    def _end_replica_reads(self):
+        token = getattr(self, '_replica_reads_token', None)
+        if token is not None:
+            _replica_reads.reset(token)
+            self._replica_reads_token = None
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        self._end_replica_reads()
+        if request.method not in SAFE_METHODS and response.status_code < 400:
+            pin_to_primary(request)
+        return super().finalize_response(request, response, *args, **kwargs)
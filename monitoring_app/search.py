@@ -0,0 +1,129 @@
+import re
+
+from django.conf import settings
+from django.db.models import Q
+from rest_framework import filters
+
+from .models import Patient, PatientSearchToken, Device, DeviceSearchToken
+
+TOKEN_RE = re.compile(r'\w+')
+MAX_TOKEN_LENGTH = 64
+
+# Appended to a prefix to get the exclusive upper bound of its range.
+_PREFIX_UPPER_BOUND = '\uffff'
+
+
+def tokenize(*values):
+    """Lower-cased word tokens of the given values, without duplicates."""
+    tokens = []
+    for value in values:
+        for token in TOKEN_RE.findall((value or '').lower()):
+            token = token[:MAX_TOKEN_LENGTH]
+            if token not in tokens:
+                tokens.append(token)
+    return tokens
+
+
+def prefix_q(field, prefix):
+    """
+    Match values of ``field`` starting with ``prefix`` as a range lookup, which
+    every backend can answer from a plain B-tree index (unlike LIKE).
+    """
+    return Q(**{field + '__gte': prefix, field + '__lt': prefix + _PREFIX_UPPER_BOUND})
+
+
+def patient_tokens(patient):
+    user = patient.user
+    return tokenize(user.username, user.first_name, user.last_name)
+
+
+def device_tokens(device):
+    return tokenize(device.device_id, device.patient.user.username)
+
+
+def index_patients(patients):
+    """Replace the search tokens of ``patients`` (with users loaded)."""
+    patients = list(patients)
+    PatientSearchToken.objects.filter(patient__in=patients).delete()
+    PatientSearchToken.objects.bulk_create([
+        PatientSearchToken(patient=patient, token=token)
+        for patient in patients
+        for token in patient_tokens(patient)
+    ], batch_size=1000)
+
+
+def index_devices(devices):
+    """Replace the search tokens of ``devices`` (with patient users loaded)."""
+    devices = list(devices)
+    DeviceSearchToken.objects.filter(device__in=devices).delete()
+    DeviceSearchToken.objects.bulk_create([
+        DeviceSearchToken(device=device, token=token)
+        for device in devices
+        for token in device_tokens(device)
+    ], batch_size=1000)
+
+
+def _in_chunks(queryset, chunk_size):
+    last_pk = 0
+    while True:
+        chunk = list(queryset.filter(pk__gt=last_pk).order_by('pk')[:chunk_size])
+        if not chunk:
+            return
+        yield chunk
+        last_pk = chunk[-1].pk
+
+
+def rebuild_index(chunk_size=1000, progress=None):
+    """
+    Rebuild the whole search index, one chunk of rows at a time. ``progress``
+    is called with the percentage done after each chunk.
+    """
+    total = Patient.objects.count() + Device.objects.count()
+    done = 0
+    for patients in _in_chunks(Patient.objects.select_related('user'), chunk_size):
+        index_patients(patients)
+        done += len(patients)
+        if progress is not None:
+            progress(100 * done / total)
+    for devices in _in_chunks(Device.objects.select_related('patient__user'), chunk_size):
+        index_devices(devices)
+        done += len(devices)
+        if progress is not None:
+            progress(100 * done / total)
+
+
+def filter_by_tokens(queryset, index_field, terms):
+    """Narrow ``queryset`` to rows with a token starting with each of ``terms``."""
+    relation = queryset.model._meta.get_field(index_field)
+    tokens = relation.related_model.objects
+    for term in terms:
+        matches = tokens.filter(prefix_q('token', term)).values(relation.field.name)
+        queryset = queryset.filter(pk__in=matches)
+    return queryset
+
+
+def search_index_enabled():
+    return getattr(settings, 'SEARCH_INDEX_ENABLED', True)
+
+
+class IndexedSearchFilter(filters.SearchFilter):
+    """
+    SearchFilter that answers each search term with a prefix range scan over
+    the token table named by the view's ``search_index_field`` (the reverse
+    relation, e.g. ``'search_tokens'``) instead of ``icontains`` joins.
+    Every term must match the start of some word.
+
+    Falls back to the regular ``search_fields`` behaviour when the view has no
+    index or SEARCH_INDEX_ENABLED is off.
+    """
+
+    def filter_queryset(self, request, queryset, view):
+        index_field = getattr(view, 'search_index_field', None)
+        if index_field is None or not search_index_enabled():
+            return super().filter_queryset(request, queryset, view)
+
+        terms = tokenize(*self.get_search_terms(request))
+        if not terms:
+            return queryset
+
+        return filter_by_tokens(queryset, index_field, terms)
@@ -1,7 +1,11 @@
+import inspect
+from datetime import timedelta
+from django.utils import timezone
 from rest_framework import serializers
 from django.contrib.auth import authenticate
 from django.contrib.auth.password_validation import validate_password
-from .models import User, Patient, HeartRateData, Device
+from .models import User, Patient, HeartRateData, Device, Task
+from .tasks import REGISTRY
 
 class UserRegistrationSerializer(serializers.ModelSerializer):
     password = serializers.CharField(write_only=True, validators=[validate_password])
@@ -113,4 +117,66 @@ class HeartRateDataSerializer(serializers.ModelSerializer):
         if not hasattr(user, 'patient_profile') and 'patient' not in attrs:
             raise serializers.ValidationError({"patient": "This field is required for staff/admin users."})
         
-        return attrs
\ No newline at end of file
+        return attrs
+
+class PatientEnrollmentSerializer(serializers.Serializer):
+    """One row of a bulk enrollment; uniqueness is checked for the whole batch."""
+    username = serializers.CharField(max_length=150, validators=[User.username_validator])
+    email = serializers.EmailField()
+    first_name = serializers.CharField(max_length=150, required=False, allow_blank=True, default='')
+    last_name = serializers.CharField(max_length=150, required=False, allow_blank=True, default='')
+    phone_number = serializers.CharField(max_length=15, required=False, allow_blank=True, default='')
+    password = serializers.CharField(write_only=True, required=False, validators=[validate_password])
+    date_of_birth = serializers.DateField()
+    gender = serializers.ChoiceField(choices=Patient.GENDER_CHOICES)
+    address = serializers.CharField(required=False, allow_blank=True, allow_null=True)
+    emergency_contact = serializers.CharField(max_length=100, required=False, allow_blank=True, allow_null=True)
+    medical_history = serializers.CharField(required=False, allow_blank=True, allow_null=True)
+    device_id = serializers.CharField(max_length=50, required=False)
+
+class AcceptInviteSerializer(serializers.Serializer):
+    uid = serializers.CharField()
+    token = serializers.CharField()
+    password = serializers.CharField(write_only=True, validators=[validate_password])
+
+class CoverageWindowSerializer(serializers.Serializer):
+    """Query parameters of the coverage endpoints; the window defaults to the last 24 hours."""
+    start = serializers.DateTimeField(required=False)
+    end = serializers.DateTimeField(required=False)
+    min_gap = serializers.IntegerField(required=False, min_value=1, help_text='Seconds')
+    after = serializers.IntegerField(required=False, min_value=0, help_text='Device id the gap scan continues after')
+
+    def validate(self, attrs):
+        attrs.setdefault('end', timezone.now())
+        attrs.setdefault('start', attrs['end'] - timedelta(days=1))
+        if attrs['start'] >= attrs['end']:
+            raise serializers.ValidationError({"start": "Must be before end."})
+        return attrs
+
+class TaskSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Task
+        fields = ('id', 'name', 'arguments', 'status', 'progress', 'result', 'error', 'attempts',
+                  'max_retries', 'cancel_requested', 'run_after', 'created_by', 'created_at',
+                  'started_at', 'finished_at')
+        read_only_fields = ('status', 'progress', 'result', 'error', 'attempts', 'cancel_requested',
+                            'run_after', 'created_by', 'created_at', 'started_at', 'finished_at')
+
+    def validate_name(self, value):
+        if value not in REGISTRY:
+            raise serializers.ValidationError("Unknown task. Choose from: %s." % ', '.join(sorted(REGISTRY)))
+        return value
+
+    def validate_arguments(self, value):
+        if not isinstance(value, dict):
+            raise serializers.ValidationError("Must be an object of keyword arguments.")
+        return value
+
+    def validate(self, attrs):
+        # Check the arguments against the task function now rather than let
+        # the task fail (and be retried) in a worker. None stands in for the context.
+        try:
+            inspect.signature(REGISTRY[attrs['name']]).bind(None, **attrs.get('arguments', {}))
+        except TypeError as exc:
+            raise serializers.ValidationError({"arguments": str(exc)})
+        return attrs
@@ -0,0 +1,36 @@
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+
+from . import coverage, search
+from .models import User, Patient, Device, HeartRateData
+
+SEARCHABLE_USER_FIELDS = {'username', 'first_name', 'last_name'}
+
+
+@receiver(post_save, sender=User)
+def reindex_user(sender, instance, raw=False, update_fields=None, **kwargs):
+    # Logins save last_login only; don't reindex for those.
+    if raw or (update_fields and not SEARCHABLE_USER_FIELDS & set(update_fields)):
+        return
+    patient = Patient.objects.filter(user=instance).first()
+    if patient is not None:
+        search.index_patients([patient])
+        search.index_devices(patient.devices.select_related('patient__user'))
+
+
+@receiver(post_save, sender=Patient)
+def reindex_patient(sender, instance, raw=False, **kwargs):
+    if not raw:
+        search.index_patients([instance])
+
+
+@receiver(post_save, sender=Device)
+def reindex_device(sender, instance, raw=False, **kwargs):
+    if not raw:
+        search.index_devices([instance])
+
+
+@receiver(post_save, sender=HeartRateData)
+def update_coverage(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        coverage.record_readings([(instance.device_id, instance.patient_id, instance.recorded_at)])
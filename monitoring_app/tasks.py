@@ -0,0 +1,247 @@
+import csv
+import os
+import traceback
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, close_old_connections
+from django.db.models import Avg, Count, F, Max, Min, Q
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from . import coverage, search
+from .models import HeartRateData, Patient, Task
+from .routers import replica_reads
+
+REGISTRY = {}
+EXPORT_PAGE_SIZE = 5000
+COHORT_CHUNK_SIZE = 500
+
+
+class TaskCancelled(Exception):
+    pass
+
+
+def task(name):
+    """Register a function as a background task. It is called as fn(context, **arguments)."""
+    def decorator(fn):
+        REGISTRY[name] = fn
+        return fn
+    return decorator
+
+
+class TaskContext:
+    """Handed to running tasks to report progress and notice cancellation."""
+
+    def __init__(self, task):
+        self.task = task
+
+    def set_progress(self, percent):
+        """
+        Save progress (0-100) and renew the task's lease; raises TaskCancelled
+        if cancellation was requested or the task was taken away from this
+        worker after its lease expired.
+        """
+        claim = claimed(self.task.pk, self.task.attempts)
+        if not claim.update(progress=round(percent, 2), claimed_until=lease_expiry()):
+            raise TaskCancelled()
+        if claim.filter(cancel_requested=True).exists():
+            raise TaskCancelled()
+
+
+def claimed(task_id, attempt=None):
+    """
+    The task while it is still running, and given ``attempt`` still under the
+    claim that made that attempt. Final updates go through this so a worker
+    whose task was cancelled or reclaimed meanwhile can't overwrite its state.
+    """
+    tasks = Task.objects.db_manager(DEFAULT_DB_ALIAS).filter(pk=task_id, status='running')
+    return tasks if attempt is None else tasks.filter(attempts=attempt)
+
+
+def lease_expiry():
+    return timezone.now() + timedelta(seconds=getattr(settings, 'TASK_LEASE_SECONDS', 300))
+
+
+def lease_expired(now):
+    return Q(status='running') & (Q(claimed_until__lt=now) | Q(claimed_until__isnull=True))
+
+
+def renew_leases(task_ids):
+    """Extend the leases of running tasks this worker is still working on."""
+    Task.objects.filter(pk__in=task_ids, status='running').update(claimed_until=lease_expiry())
+
+
+def enqueue(name, arguments=None, user=None, max_retries=None):
+    if name not in REGISTRY:
+        raise KeyError('Unknown task %r' % name)
+    return Task.objects.create(
+        name=name,
+        arguments=arguments or {},
+        created_by=user,
+        max_retries=getattr(settings, 'TASK_MAX_RETRIES', 3) if max_retries is None else max_retries,
+    )
+
+
+def cancel(task):
+    """
+    Cancel a pending task, or a running one whose worker has gone, now; ask a
+    live running task to stop. Returns False if it already finished.
+    """
+    now = timezone.now()
+    tasks = Task.objects.filter(pk=task.pk)
+    if tasks.filter(Q(status='pending') | lease_expired(now)).update(status='cancelled', finished_at=now):
+        return True
+    return bool(tasks.filter(status='running').update(cancel_requested=True))
+
+
+def reclaim_expired():
+    """Retry (or finish cancelling) running tasks whose worker stopped renewing the lease."""
+    now = timezone.now()
+    for pk, attempt in Task.objects.filter(lease_expired(now)).values_list('pk', 'attempts')[:10]:
+        # Take the lease first so only one worker reclaims each task.
+        if not claimed(pk, attempt).filter(lease_expired(now)).update(claimed_until=lease_expiry()):
+            continue
+        if not claimed(pk, attempt).filter(cancel_requested=True).update(status='cancelled', finished_at=now):
+            fail(pk, 'The worker running this task stopped before it finished.', attempt)
+
+
+def claim_next():
+    """
+    Mark the next due task as running and return its id, or None. The claim is
+    a conditional UPDATE, so several workers can poll the same table safely.
+    """
+    reclaim_expired()
+    now = timezone.now()
+    due = Task.objects.filter(status='pending', run_after__lte=now).order_by('run_after', 'pk')
+    for pk in due.values_list('pk', flat=True)[:10]:
+        claimed = Task.objects.filter(pk=pk, status='pending').update(
+            status='running', started_at=now, claimed_until=lease_expiry(), attempts=F('attempts') + 1)
+        if claimed:
+            return pk
+    return None
+
+
+def release(task_id, attempt=None):
+    """Give an interrupted task back to the queue without counting the attempt."""
+    now = timezone.now()
+    tasks = claimed(task_id, attempt)
+    if not tasks.filter(cancel_requested=True).update(status='cancelled', finished_at=now):
+        tasks.update(status='pending', run_after=now, claimed_until=None, attempts=F('attempts') - 1)
+
+
+def fail(task_id, error, attempt=None):
+    """
+    Put a failed task back in the queue with exponential backoff, or give up
+    after max_retries. Returns False, changing nothing, if the task is no
+    longer running under ``attempt``.
+    """
+    task = claimed(task_id, attempt).first()
+    if task is None:
+        return False
+    if task.attempts <= task.max_retries and not task.cancel_requested:
+        delay = getattr(settings, 'TASK_RETRY_DELAY_SECONDS', 30) * 2 ** (task.attempts - 1)
+        changes = {'status': 'pending', 'run_after': timezone.now() + timedelta(seconds=delay)}
+    else:
+        changes = {'status': 'failed', 'finished_at': timezone.now()}
+    return bool(claimed(task_id, task.attempts).update(error=error, claimed_until=None, **changes))
+
+
+def execute(task_id):
+    """Run a claimed task to completion. This is what worker processes call."""
+    close_old_connections()
+    try:
+        task = Task.objects.db_manager(DEFAULT_DB_ALIAS).get(pk=task_id)
+        if task.status != 'running':
+            return
+        try:
+            result = REGISTRY[task.name](TaskContext(task), **task.arguments)
+        except TaskCancelled:
+            claimed(task_id, task.attempts).update(
+                status='cancelled', claimed_until=None, finished_at=timezone.now())
+        except Exception:
+            fail(task_id, traceback.format_exc(), task.attempts)
+        except BaseException:
+            # Ctrl-C or shutdown: the task did nothing wrong, so run it again later.
+            release(task_id, task.attempts)
+            raise
+        else:
+            claimed(task_id, task.attempts).update(
+                status='succeeded', progress=100, result=result, error='', claimed_until=None,
+                finished_at=timezone.now())
+    finally:
+        close_old_connections()
+
+
+def _readings(patient=None, device=None, start=None, end=None):
+    readings = HeartRateData.objects.all()
+    if patient is not None:
+        readings = readings.filter(patient=patient)
+    if device is not None:
+        readings = readings.filter(device=device)
+    if start is not None:
+        readings = readings.filter(recorded_at__gte=parse_datetime(start))
+    if end is not None:
+        readings = readings.filter(recorded_at__lt=parse_datetime(end))
+    return readings
+
+
+@task('rebuild_coverage_index')
+def rebuild_coverage_index(context):
+    coverage.rebuild_index(progress=context.set_progress)
+
+
+@task('rebuild_search_index')
+def rebuild_search_index(context):
+    search.rebuild_index(progress=context.set_progress)
+
+
+@task('export_heart_rate')
+def export_heart_rate(context, patient=None, device=None, start=None, end=None):
+    """Write matching readings to a CSV file in import_heart_rate's format."""
+    export_dir = getattr(settings, 'TASK_EXPORT_DIR', settings.BASE_DIR / 'exports')
+    os.makedirs(export_dir, exist_ok=True)
+    path = os.path.join(export_dir, 'heart-rate-%d.csv' % context.task.pk)
+    with replica_reads():
+        readings = _readings(patient, device, start, end).order_by('recorded_at', 'pk')
+        total = readings.count()
+        values = readings.values_list('pk', 'device__device_id', 'patient_id', 'heart_rate', 'recorded_at')
+        rows = 0
+        try:
+            with open(path, 'w', newline='') as f:
+                writer = csv.writer(f)
+                writer.writerow(['device_id', 'patient', 'heart_rate', 'recorded_at'])
+                # Keyset pages over the (recorded_at, id) index rather than one long
+                # cursor, so no read stays open while progress is saved.
+                page = list(values[:EXPORT_PAGE_SIZE])
+                while page:
+                    for pk, device_id, patient_id, heart_rate, recorded_at in page:
+                        writer.writerow([device_id, patient_id, heart_rate, recorded_at.isoformat()])
+                    rows += len(page)
+                    context.set_progress(100 * rows / total)
+                    last_pk, last_recorded_at = page[-1][0], page[-1][4]
+                    page = list(values.filter(
+                        Q(recorded_at__gt=last_recorded_at) | Q(recorded_at=last_recorded_at, pk__gt=last_pk)
+                    )[:EXPORT_PAGE_SIZE])
+        except BaseException:
+            os.remove(path)
+            raise
+    return {'file': os.path.basename(path), 'rows': rows}
+
+
+@task('cohort_stats')
+def cohort_stats(context, patients=None, start=None, end=None):
+    """Min, max, average and count of heart rates per patient in the window."""
+    results = []
+    with replica_reads():
+        if patients is None:
+            patients = list(Patient.objects.order_by('pk').values_list('pk', flat=True))
+        # One aggregate per chunk of patients, so progress and cancellation
+        # are checked between them.
+        for done in range(0, len(patients), COHORT_CHUNK_SIZE):
+            chunk = patients[done:done + COHORT_CHUNK_SIZE]
+            stats = (_readings(start=start, end=end).filter(patient__in=chunk).order_by().values('patient')
+                     .annotate(min=Min('heart_rate'), max=Max('heart_rate'), avg=Avg('heart_rate'), count=Count('id')))
+            results.extend(stats)
+            context.set_progress(100 * (done + len(chunk)) / len(patients))
+    return {'patients': results}
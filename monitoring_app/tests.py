@@ -1,10 +1,30 @@
 # tests.py
-from django.test import TestCase
+import io
+import os
+import tempfile
+from datetime import datetime, timedelta, timezone as dt_timezone
+from unittest import mock
+from django.contrib.auth.hashers import check_password, is_password_usable
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
-from rest_framework.test import APITestCase, APIClient
+from django.utils import timezone
+from rest_framework.test import APIClient, APIRequestFactory, APITestCase
+from rest_framework.views import APIView
 from rest_framework import status
+from rest_framework.pagination import PageNumberPagination
+from rest_framework.authtoken.models import Token
 from django.contrib.auth import get_user_model
-from .models import Patient, Device, HeartRateData
+from . import coverage, enrollment, tasks
+from .checks import check_primary_pin_cache
+from .enrollment import hash_passwords
+from .models import Patient, Device, DeviceCoverageInterval, HeartRateData, ImportCheckpoint, Task
+from .routers import PrimaryReplicaRouter, ReplicaReadMixin, _replica_reads, is_pinned_to_primary
+from .throttling import CacheBucketStore, LocalBucketStore, get_store, take
 
 User = get_user_model()
 
@@ -156,4 +176,690 @@ class HeartRateDataTests(APITestCase):
         
         response = self.client.get(self.heart_rate_url)
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertEqual(len(response.json()['results']), 1)
\ No newline at end of file
+        self.assertEqual(len(response.json()['results']), 1)
+
+class ReplicaRoutingTests(SimpleTestCase):
+    def setUp(self):
+        self.router = PrimaryReplicaRouter()
+
+    def test_reads_outside_replica_views_use_primary(self):
+        with mock.patch('monitoring_app.routers.get_replica_aliases', return_value=['replica1']):
+            self.assertEqual(self.router.db_for_read(HeartRateData), 'default')
+
+    def test_replica_reads_and_primary_writes(self):
+        token = _replica_reads.set(True)
+        try:
+            with mock.patch('monitoring_app.routers.get_replica_aliases', return_value=['replica1']):
+                self.assertEqual(self.router.db_for_read(HeartRateData), 'replica1')
+                self.assertEqual(self.router.db_for_write(HeartRateData), 'default')
+        finally:
+            _replica_reads.reset(token)
+
+    def test_replica_reads_end_when_view_raises(self):
+        class FailingView(ReplicaReadMixin, APIView):
+            permission_classes = []
+
+            def get(self, request):
+                raise RuntimeError('replica down')
+
+        view = FailingView.as_view()
+        with self.assertRaises(RuntimeError):
+            view(APIRequestFactory().get('/'))
+        self.assertFalse(_replica_reads.get())
+
+    @override_settings(DATABASE_READ_REPLICAS=['replica1'])
+    def test_check_warns_about_process_local_pin_cache(self):
+        self.assertEqual([w.id for w in check_primary_pin_cache(None)], ['monitoring_app.W001'])
+        shared = {'default': {'BACKEND': 'django.core.cache.backends.redis.RedisCache'}}
+        with override_settings(CACHES=shared):
+            self.assertEqual(check_primary_pin_cache(None), [])
+
+
+class ReadYourWritesTests(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.admin_user = User.objects.create_superuser(
+            username='admin',
+            password='adminpass',
+            email='admin@example.com'
+        )
+        self.token = Token.objects.create(user=self.admin_user)
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + self.token.key)
+
+    def test_write_pins_client_to_primary(self):
+        request = mock.Mock(auth=self.token, user=self.admin_user)
+        self.assertFalse(is_pinned_to_primary(request))
+
+        patient_user = User.objects.create_user(username='patient', password='patientpass', user_type='patient')
+        patient = Patient.objects.create(user=patient_user, date_of_birth='1990-01-01', gender='M')
+        response = self.client.post(reverse('device-list'), {'device_id': 'DEV001', 'patient': patient.pk})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertTrue(is_pinned_to_primary(request))
+
+    def test_failed_write_does_not_pin(self):
+        request = mock.Mock(auth=self.token, user=self.admin_user)
+        response = self.client.post(reverse('device-list'), {'device_id': 'DEV001'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(is_pinned_to_primary(request))
+
+
+class SearchIndexTests(APITestCase):
+    def setUp(self):
+        self.admin_user = User.objects.create_superuser(
+            username='admin',
+            password='adminpass',
+            email='admin@example.com'
+        )
+        self.patient_user = User.objects.create_user(
+            username='jdoe',
+            password='patientpass',
+            first_name='John',
+            last_name='Doe-Smith',
+            user_type='patient'
+        )
+        self.patient = Patient.objects.create(
+            user=self.patient_user,
+            date_of_birth='1990-01-01',
+            gender='M'
+        )
+        self.device = Device.objects.create(device_id='DEV-001', patient=self.patient)
+        other_user = User.objects.create_user(username='asmith', first_name='Alice', password='pass')
+        Patient.objects.create(user=other_user, date_of_birth='1985-01-01', gender='F')
+
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.admin_user)
+
+    def search_patients(self, term):
+        response = self.client.get(reverse('patient-list'), {'search': term})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return [patient['username'] for patient in response.json()['results']]
+
+    def test_prefix_search_on_index(self):
+        self.assertEqual(self.search_patients('jo'), ['jdoe'])
+        # 'smi' starts 'smith' in "Doe-Smith" but only appears inside 'asmith'.
+        self.assertEqual(self.search_patients('SMI'), ['jdoe'])
+
+    def test_index_follows_user_changes(self):
+        self.patient_user.first_name = 'Jack'
+        self.patient_user.save()
+        self.assertEqual(self.search_patients('john'), [])
+        self.assertEqual(self.search_patients('jack doe'), ['jdoe'])
+
+    def test_device_search(self):
+        response = self.client.get(reverse('device-list'), {'search': 'dev jdo'})
+        self.assertEqual([device['device_id'] for device in response.json()['results']], ['DEV-001'])
+
+    @override_settings(SEARCH_INDEX_ENABLED=False)
+    def test_fallback_without_index(self):
+        self.assertEqual(self.search_patients('oe-sm'), ['jdoe'])
+
+
+class HeartRateDataAdminTests(TestCase):
+    def setUp(self):
+        self.admin_user = User.objects.create_superuser(
+            username='admin',
+            password='adminpass',
+            email='admin@example.com'
+        )
+        patient_user = User.objects.create_user(username='jdoe', first_name='John', password='pass', user_type='patient')
+        self.patient = Patient.objects.create(user=patient_user, date_of_birth='1990-01-01', gender='M')
+        self.device = Device.objects.create(device_id='DEV001', patient=self.patient)
+        HeartRateData.objects.bulk_create([
+            HeartRateData(device=self.device, patient=self.patient, heart_rate=60 + i,
+                          recorded_at=timezone.now() - timedelta(days=i))
+            for i in range(10)
+        ])
+        self.client.force_login(self.admin_user)
+        self.url = reverse('admin:monitoring_app_heartratedata_changelist')
+
+    def test_changelist_uses_estimated_count(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, '10 heart rate datas')
+        self.assertNotIn('COUNT(*)', ' '.join(query['sql'] for query in queries.captured_queries))
+
+    def test_date_range_filter(self):
+        response = self.client.get(self.url, {'recorded_within': '7d'})
+        self.assertEqual(len(response.context['cl'].result_list), 7)
+
+    def test_search_by_device_and_patient_name(self):
+        response = self.client.get(self.url, {'q': 'DEV001'})
+        self.assertEqual(len(response.context['cl'].result_list), 10)
+        response = self.client.get(self.url, {'q': 'joh'})
+        self.assertEqual(len(response.context['cl'].result_list), 10)
+        response = self.client.get(self.url, {'q': 'DEV'})
+        self.assertEqual(len(response.context['cl'].result_list), 0)
+
+    def test_search_does_not_join_devices(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(self.url, {'q': 'DEV001'})
+        self.assertEqual(len(response.context['cl'].result_list), 10)
+        changelist_sql = [query['sql'] for query in queries.captured_queries if '"heart_rate_data"' in query['sql']]
+        self.assertTrue(changelist_sql)
+        for sql in changelist_sql:
+            self.assertNotIn('"devices"."device_id" =', sql)
+
+
+class ImportHeartRateCommandTests(TestCase):
+    def setUp(self):
+        patient_user = User.objects.create_user(username='patient', password='patientpass', user_type='patient')
+        self.patient = Patient.objects.create(user=patient_user, date_of_birth='1990-01-01', gender='M')
+        self.device = Device.objects.create(device_id='DEV001', patient=self.patient)
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+
+    def write_file(self, name, content):
+        path = os.path.join(self.tmpdir.name, name)
+        with open(path, 'w') as f:
+            f.write(content)
+        return path
+
+    def import_file(self, path, *args):
+        out, err = io.StringIO(), io.StringIO()
+        call_command('import_heart_rate', path, *args, stdout=out, stderr=err)
+        return out.getvalue(), err.getvalue()
+
+    def test_import_csv_with_invalid_rows(self):
+        path = self.write_file('readings.csv', (
+            'device_id,heart_rate,recorded_at\n'
+            'DEV001,72,2023-05-01T12:00:00Z\n'
+            'DEV001,300,2023-05-01T12:01:00Z\n'
+            'DEV999,70,2023-05-01T12:02:00Z\n'
+            'DEV001,75,2023-05-01 12:03:00\n'
+        ))
+        out, err = self.import_file(path, '--workers', '0', '--chunk-size', '2')
+        self.assertEqual(HeartRateData.objects.count(), 2)
+        self.assertEqual(HeartRateData.objects.first().patient, self.patient)
+        self.assertIn('line 3: heart_rate 300 outside 30-250', err)
+        self.assertIn("line 4: unknown device_id 'DEV999'", err)
+        self.assertIn('2 rows imported, 2 rejected', out)
+
+    def test_import_csv_with_byte_order_mark(self):
+        path = os.path.join(self.tmpdir.name, 'excel.csv')
+        with open(path, 'w', encoding='utf-8-sig') as f:
+            f.write('device_id,heart_rate,recorded_at\nDEV001,72,2023-05-01T12:00:00Z\n')
+        self.import_file(path, '--workers', '0')
+        self.assertEqual(HeartRateData.objects.count(), 1)
+
+    def test_import_ndjson_in_process_pool(self):
+        path = self.write_file('readings.ndjson', ''.join(
+            '{"device_id": "DEV001", "heart_rate": %d, "recorded_at": "2023-05-01T12:%02d:00Z"}\n' % (60 + i, i)
+            for i in range(50)
+        ))
+        self.import_file(path, '--workers', '2', '--chunk-size', '7', '--batch-size', '3')
+        self.assertEqual(HeartRateData.objects.count(), 50)
+
+    def test_resume_from_checkpoint(self):
+        path = self.write_file('readings.csv', (
+            'device_id,heart_rate,recorded_at\n'
+            'DEV001,72,2023-05-01T12:00:00Z\n'
+            'DEV001,73,2023-05-01T12:01:00Z\n'
+        ))
+        self.import_file(path, '--workers', '0')
+        out, _ = self.import_file(path, '--workers', '0')
+        self.assertIn('Resuming', out)
+        self.assertEqual(HeartRateData.objects.count(), 2)
+
+        with open(path, 'a') as f:
+            f.write('DEV001,74,2023-05-01T12:02:00Z\n')
+        self.import_file(path, '--workers', '0')
+        self.assertEqual(HeartRateData.objects.count(), 3)
+        self.assertEqual(ImportCheckpoint.objects.get().line, 4)
+
+    def test_changed_file_is_not_resumed(self):
+        path = self.write_file('readings.csv', ''.join(
+            ['device_id,heart_rate,recorded_at\n'] +
+            ['DEV001,%d,2023-05-01T12:%02d:00Z\n' % (60 + i, i) for i in range(50)]
+        ))
+        self.import_file(path, '--workers', '0')
+        self.write_file('readings.csv', ''.join(
+            ['device_id,heart_rate,recorded_at\n'] +
+            ['DEV001,%d,2023-05-02T12:%02d:00Z\n' % (60 + i, i) for i in range(60)]
+        ))
+        with self.assertRaisesMessage(CommandError, 'has changed since it was imported up to line 51'):
+            self.import_file(path, '--workers', '0')
+        self.write_file('readings.csv', 'device_id,heart_rate,recorded_at\nDEV001,72,2023-05-03T12:00:00Z\n')
+        with self.assertRaisesMessage(CommandError, 'pass --restart'):
+            self.import_file(path, '--workers', '0')
+
+        self.import_file(path, '--workers', '0', '--restart')
+        self.assertEqual(HeartRateData.objects.count(), 51)
+
+
+class ImportHeartRateDropIndexesTests(TransactionTestCase):
+    def test_indexes_are_rebuilt(self):
+        patient_user = User.objects.create_user(username='patient', password='patientpass', user_type='patient')
+        patient = Patient.objects.create(user=patient_user, date_of_birth='1990-01-01', gender='M')
+        Device.objects.create(device_id='DEV001', patient=patient)
+        with tempfile.NamedTemporaryFile('w', suffix='.csv') as f:
+            f.write('device_id,heart_rate,recorded_at\nDEV001,72,2023-05-01T12:00:00Z\n')
+            f.flush()
+            call_command('import_heart_rate', f.name, '--workers', '0', '--drop-indexes', stdout=io.StringIO())
+        self.assertEqual(HeartRateData.objects.count(), 1)
+        with connection.cursor() as cursor:
+            constraints = connection.introspection.get_constraints(cursor, HeartRateData._meta.db_table)
+        for index in HeartRateData._meta.indexes:
+            self.assertIn(index.name, constraints)
+
+
+class BulkEnrollmentTests(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.admin_user = User.objects.create_superuser(
+            username='admin',
+            password='adminpass',
+            email='admin@example.com'
+        )
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.admin_user)
+        self.url = reverse('patient-bulk-enroll')
+
+    def row(self, username, **extra):
+        row = {
+            'username': username,
+            'email': '%s@example.com' % username,
+            'first_name': username.title(),
+            'date_of_birth': '1990-01-01',
+            'gender': 'F',
+        }
+        row.update(extra)
+        return row
+
+    def test_bulk_enroll_with_row_errors(self):
+        rows = [
+            self.row('alice', password='Str0ng-passphrase', device_id='DEV-A'),
+            self.row('bob', device_id='DEV-B'),
+            self.row('admin'),
+            self.row('carol', device_id='DEV-A'),
+            self.row('dave', gender='X'),
+        ]
+        response = self.client.post(self.url, rows, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        data = response.json()
+        self.assertEqual([entry['row'] for entry in data['created']], [0, 1])
+        self.assertEqual([entry['row'] for entry in data['errors']], [2, 3, 4])
+        self.assertIn('username', data['errors'][0]['errors'])
+        self.assertIn('device_id', data['errors'][1]['errors'])
+
+        alice = User.objects.get(username='alice')
+        self.assertTrue(alice.check_password('Str0ng-passphrase'))
+        self.assertEqual(alice.patient_profile.devices.get().device_id, 'DEV-A')
+        self.assertNotIn('invite', data['created'][0])
+        self.assertFalse(User.objects.get(username='bob').has_usable_password())
+        self.assertEqual(Patient.objects.filter(search_tokens__token='bob').count(), 1)
+        self.assertTrue(is_pinned_to_primary(mock.Mock(auth=None, user=self.admin_user)))
+
+    def test_invite_sets_password(self):
+        response = self.client.post(self.url, [self.row('bob')], format='json')
+        invite = response.json()['created'][0]['invite']
+
+        self.client.force_authenticate(user=None)
+        response = self.client.post(reverse('accept-invite'), dict(invite, password='An0ther-passphrase'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(User.objects.get(username='bob').check_password('An0ther-passphrase'))
+        token = Token.objects.get(key=response.json()['token'])
+        self.assertTrue(is_pinned_to_primary(mock.Mock(auth=token, user=token.user)))
+        response = self.client.post(reverse('accept-invite'), dict(invite, password='An0ther-passphrase'))
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_concurrent_batch_taking_a_username_is_reported_per_row(self):
+        User.objects.create_user(username='alice', password='pass', user_type='patient')
+        validate_rows = enrollment.validate_rows
+        calls = []
+
+        def validate_before_other_batch_commits(rows):
+            calls.append(rows)
+            if len(calls) > 1:
+                return validate_rows(rows)
+            with mock.patch('monitoring_app.enrollment._existing', return_value=set()):
+                return validate_rows(rows)
+
+        with mock.patch('monitoring_app.enrollment.validate_rows', side_effect=validate_before_other_batch_commits):
+            response = self.client.post(self.url, [self.row('alice'), self.row('bob')], format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        data = response.json()
+        self.assertEqual([entry['username'] for entry in data['created']], ['bob'])
+        self.assertEqual(data['errors'], [{'row': 0, 'errors': {'username': ['alice already exists.']}}])
+
+    @override_settings(ENROLLMENT_HASH_WORKERS=2, ENROLLMENT_POOL_THRESHOLD=2)
+    def test_passwords_hashed_in_process_pool(self):
+        hashed = hash_passwords(['first-passphrase', None, 'second-passphrase'])
+        self.assertTrue(check_password('first-passphrase', hashed[0]))
+        self.assertFalse(is_password_usable(hashed[1]))
+        self.assertTrue(check_password('second-passphrase', hashed[2]))
+
+    def test_staff_cannot_bulk_enroll(self):
+        staff_user = User.objects.create_user(username='staff', password='staffpass', user_type='staff')
+        self.client.force_authenticate(user=staff_user)
+        response = self.client.post(self.url, [self.row('bob')], format='json')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+
+class TokenBucketTests(SimpleTestCase):
+    def test_take_refills_up_to_burst(self):
+        self.assertEqual(take(0, 0, 10, rate=1, burst=3), (2, 0))
+        self.assertEqual(take(0.5, 0, 0, rate=2, burst=3), (0.5, 0.25))
+
+    def test_local_store_limits_burst(self):
+        store = LocalBucketStore()
+        waits = [store.consume('device:1', rate=0.01, burst=3) for _ in range(4)]
+        self.assertEqual(waits[:3], [0, 0, 0])
+        self.assertGreater(waits[3], 0)
+        self.assertEqual(store.consume('device:2', rate=0.01, burst=3), 0)
+
+    @mock.patch('monitoring_app.throttling.LOCAL_STORE_PRUNE_SIZE', 10)
+    def test_local_store_prunes_less_often_while_buckets_are_live(self):
+        store = LocalBucketStore()
+        with mock.patch.object(store, 'prune', wraps=store.prune) as prune:
+            for i in range(1000):
+                store.consume('device:%d' % i, rate=0.01, burst=3)
+        self.assertEqual(len(store.buckets), 1000)
+        self.assertLessEqual(prune.call_count, 7)
+
+
+@override_settings(INGEST_THROTTLES={'device': {'rate': '1/m', 'burst': 2}})
+class IngestThrottleTests(APITestCase):
+    def setUp(self):
+        self.patient_user = User.objects.create_user(username='patient', password='patientpass', user_type='patient')
+        self.patient = Patient.objects.create(user=self.patient_user, date_of_birth='1990-01-01', gender='M')
+        self.device = Device.objects.create(device_id='DEV001', patient=self.patient)
+        self.other_device = Device.objects.create(device_id='DEV002', patient=self.patient)
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.patient_user)
+        self.url = reverse('heart-rate-list')
+
+    def post(self, device):
+        return self.client.post(self.url, {
+            'device': device.pk,
+            'patient': self.patient.pk,
+            'heart_rate': 72,
+            'recorded_at': '2023-05-01T12:00:00Z'
+        })
+
+    def test_device_is_throttled_after_burst(self):
+        self.assertEqual(self.post(self.device).status_code, status.HTTP_201_CREATED)
+        self.assertEqual(self.post(self.device).status_code, status.HTTP_201_CREATED)
+        response = self.post(self.device)
+        self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertEqual(response['Retry-After'], '60')
+
+        self.assertEqual(self.post(self.other_device).status_code, status.HTTP_201_CREATED)
+        self.assertEqual(self.client.get(self.url).status_code, status.HTTP_200_OK)
+
+    @override_settings(INGEST_THROTTLE_BACKEND='cache')
+    def test_shared_cache_backend(self):
+        cache.clear()
+        self.post(self.device)
+        self.post(self.device)
+        self.assertEqual(self.post(self.device).status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertIsInstance(get_store(), CacheBucketStore)
+
+
+class CoverageIndexTests(APITestCase):
+    def setUp(self):
+        self.admin_user = User.objects.create_superuser(
+            username='admin',
+            password='adminpass',
+            email='admin@example.com'
+        )
+        patient_user = User.objects.create_user(username='patient', password='patientpass', user_type='patient')
+        self.patient = Patient.objects.create(user=patient_user, date_of_birth='1990-01-01', gender='M')
+        self.device = Device.objects.create(device_id='DEV001', patient=self.patient)
+        self.idle_device = Device.objects.create(device_id='DEV002', patient=self.patient)
+        self.t0 = datetime(2023, 5, 1, 12, 0, tzinfo=dt_timezone.utc)
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.admin_user)
+
+    def add_readings(self, minutes):
+        for minute in minutes:
+            HeartRateData.objects.create(device=self.device, patient=self.patient, heart_rate=70,
+                                         recorded_at=self.t0 + timedelta(minutes=minute))
+
+    def intervals(self):
+        return [(interval.start, interval.end) for interval in self.device.coverage_intervals.all()]
+
+    def test_ingest_merges_intervals(self):
+        self.add_readings([0, 2, 4, 30, 32])
+        self.assertEqual(self.intervals(), [
+            (self.t0, self.t0 + timedelta(minutes=4)),
+            (self.t0 + timedelta(minutes=30), self.t0 + timedelta(minutes=32)),
+        ])
+        # Readings arriving out of order bridge the gap.
+        self.add_readings([8, 12, 16, 20, 24, 27])
+        self.assertEqual(self.intervals(), [(self.t0, self.t0 + timedelta(minutes=32))])
+
+    def test_batch_update_costs_constant_queries(self):
+        self.add_readings([0, 30])
+        readings = [(self.device.pk, self.patient.pk, self.t0 + timedelta(minutes=minute))
+                    for minute in [4, 8, 12, 16, 20, 24, 27]]
+        readings += [(device.pk, self.patient.pk, self.t0 + timedelta(minutes=60 + 10 * i))
+                     for device in (self.device, self.idle_device) for i in range(50)]
+        with CaptureQueriesContext(connection) as queries:
+            coverage.record_readings(readings)
+        writes = [query['sql'] for query in queries.captured_queries if 'SAVEPOINT' not in query['sql']]
+        self.assertEqual(len(writes), 4)
+        self.assertEqual(self.intervals()[0], (self.t0, self.t0 + timedelta(minutes=30)))
+        self.assertEqual(DeviceCoverageInterval.objects.count(), 101)
+
+    def test_rebuild_matches_incremental_index(self):
+        self.add_readings([0, 3, 20, 21, 60])
+        incremental = self.intervals()
+        call_command('rebuild_coverage_index', stdout=io.StringIO())
+        self.assertEqual(self.intervals(), incremental)
+
+    def test_coverage_and_gap_endpoints(self):
+        self.add_readings([0, 5, 10, 40, 45, 50])
+        window = {'start': self.t0.isoformat(), 'end': (self.t0 + timedelta(minutes=60)).isoformat()}
+
+        response = self.client.get(reverse('device-coverage'), window)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        results = {row['device_id']: row for row in response.json()['results']}
+        self.assertEqual(results['DEV001']['covered_seconds'], 1200)
+        self.assertEqual(results['DEV001']['coverage_percent'], 33.33)
+        self.assertEqual(results['DEV002']['coverage_percent'], 0)
+        self.assertEqual(results['DEV001']['last_seen'][:19], '2023-05-01T12:50:00')
+        self.assertIsNone(results['DEV002']['last_seen'])
+
+        response = self.client.get(reverse('patient-coverage'), window)
+        self.assertEqual(response.json()['results'][0]['covered_seconds'], 1200)
+
+        response = self.client.get(reverse('coverage-gaps'), dict(window, min_gap=900))
+        gaps = {row['device_id']: row['gaps'] for row in response.json()['results']}
+        self.assertEqual([gap['seconds'] for gap in gaps['DEV001']], [1800])
+        self.assertEqual([gap['seconds'] for gap in gaps['DEV002']], [3600])
+
+    def test_gap_pages_skip_devices_without_gaps(self):
+        self.add_readings(range(0, 61, 5))
+        for i in range(3, 6):
+            Device.objects.create(device_id='DEV00%d' % i, patient=self.patient)
+        window = {'start': self.t0.isoformat(), 'end': (self.t0 + timedelta(minutes=60)).isoformat(), 'min_gap': 900}
+
+        pages = []
+        url, params = reverse('coverage-gaps'), window
+        with mock.patch.object(PageNumberPagination, 'page_size', 2), \
+                mock.patch('monitoring_app.views.CoverageGapsView.scan_batch_size', 2):
+            while url:
+                data = self.client.get(url, params).json()
+                pages.append([row['device_id'] for row in data['results']])
+                url, params = data['next'], None
+        self.assertEqual(pages, [['DEV002', 'DEV003'], ['DEV004', 'DEV005'], []])
+
+    def test_coverage_requires_staff(self):
+        self.client.force_authenticate(user=self.patient.user)
+        response = self.client.get(reverse('coverage-gaps'))
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+
+@tasks.task('test_flaky')
+def flaky_task(context, failures=0):
+    if context.task.attempts <= failures:
+        raise RuntimeError('attempt %d failed' % context.task.attempts)
+    context.set_progress(50)
+    return {'attempts': context.task.attempts}
+
+
+@tasks.task('test_interrupted')
+def interrupted_task(context):
+    raise KeyboardInterrupt()
+
+
+@tasks.task('test_outlives_lease')
+def outlives_lease_task(context, then='cancel'):
+    # The lease runs out while this worker is still busy, and another worker
+    # cancels or reclaims the task.
+    Task.objects.filter(pk=context.task.pk).update(claimed_until=timezone.now() - timedelta(seconds=1))
+    if then == 'cancel':
+        tasks.cancel(context.task)
+    else:
+        tasks.claim_next()
+    return {'done': True}
+
+
+class BackgroundTaskTests(APITestCase):
+    def setUp(self):
+        self.admin_user = User.objects.create_superuser(
+            username='admin',
+            password='adminpass',
+            email='admin@example.com'
+        )
+        patient_user = User.objects.create_user(username='patient', password='patientpass', user_type='patient')
+        self.patient = Patient.objects.create(user=patient_user, date_of_birth='1990-01-01', gender='M')
+        self.device = Device.objects.create(device_id='DEV001', patient=self.patient)
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.admin_user)
+        self.export_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.export_dir.cleanup)
+
+    def run_workers(self):
+        call_command('run_workers', '--processes', '0', '--once', stdout=io.StringIO())
+
+    def test_export_task(self):
+        HeartRateData.objects.create(device=self.device, patient=self.patient, heart_rate=72,
+                                     recorded_at='2023-05-01T12:00:00Z')
+        response = self.client.post(reverse('task-list'), {
+            'name': 'export_heart_rate',
+            'arguments': {'patient': self.patient.pk},
+        }, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.json()['status'], 'pending')
+
+        with override_settings(TASK_EXPORT_DIR=self.export_dir.name):
+            self.run_workers()
+            task_url = reverse('task-detail', args=[response.json()['id']])
+            data = self.client.get(task_url).json()
+            self.assertEqual(data['status'], 'succeeded')
+            self.assertEqual(data['result']['rows'], 1)
+
+            response = self.client.get(reverse('task-download', args=[data['id']]))
+            content = b''.join(response.streaming_content).decode()
+            response.close()
+            self.assertIn('DEV001,%d,72,2023-05-01T12:00:00+00:00' % self.patient.pk, content)
+
+            os.remove(os.path.join(self.export_dir.name, data['result']['file']))
+            response = self.client.get(reverse('task-download', args=[data['id']]))
+            self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_unknown_task_rejected(self):
+        response = self.client.post(reverse('task-list'), {'name': 'nope'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_task_arguments_checked_against_signature(self):
+        response = self.client.post(reverse('task-list'), {
+            'name': 'export_heart_rate',
+            'arguments': {'patient_id': self.patient.pk},
+        }, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('arguments', response.json())
+        self.assertFalse(Task.objects.exists())
+
+    @override_settings(TASK_RETRY_DELAY_SECONDS=0)
+    def test_retries_then_fails(self):
+        recovering = tasks.enqueue('test_flaky', {'failures': 1}, max_retries=1)
+        failing = tasks.enqueue('test_flaky', {'failures': 5}, max_retries=1)
+        self.run_workers()
+        recovering.refresh_from_db()
+        failing.refresh_from_db()
+        self.assertEqual((recovering.status, recovering.result), ('succeeded', {'attempts': 2}))
+        self.assertEqual((failing.status, failing.attempts), ('failed', 2))
+        self.assertIn('attempt 2 failed', failing.error)
+
+    def test_cancel(self):
+        pending = tasks.enqueue('test_flaky')
+        response = self.client.post(reverse('task-cancel', args=[pending.pk]))
+        self.assertEqual(response.json()['status'], 'cancelled')
+        self.assertEqual(self.client.post(reverse('task-cancel', args=[pending.pk])).status_code,
+                         status.HTTP_400_BAD_REQUEST)
+
+        running = tasks.enqueue('test_flaky')
+        self.assertEqual(tasks.claim_next(), running.pk)
+        tasks.cancel(running)
+        tasks.execute(running.pk)
+        running.refresh_from_db()
+        self.assertEqual(running.status, 'cancelled')
+
+    def test_cancel_running_rebuilds(self):
+        for name in ('rebuild_coverage_index', 'rebuild_search_index', 'cohort_stats'):
+            task = tasks.enqueue(name)
+            self.assertEqual(tasks.claim_next(), task.pk)
+            tasks.cancel(task)
+            tasks.execute(task.pk)
+            task.refresh_from_db()
+            self.assertEqual(task.status, 'cancelled', name)
+
+    def test_cohort_stats(self):
+        for heart_rate in (60, 80):
+            HeartRateData.objects.create(device=self.device, patient=self.patient, heart_rate=heart_rate,
+                                         recorded_at='2023-05-01T12:00:00Z')
+        task = tasks.enqueue('cohort_stats')
+        self.run_workers()
+        task.refresh_from_db()
+        self.assertEqual(task.result['patients'], [
+            {'patient': self.patient.pk, 'min': 60, 'max': 80, 'avg': 70.0, 'count': 2},
+        ])
+
+    @override_settings(TASK_RETRY_DELAY_SECONDS=0)
+    def test_expired_lease_is_reclaimed(self):
+        task = tasks.enqueue('test_flaky')
+        self.assertEqual(tasks.claim_next(), task.pk)
+        self.assertIsNone(tasks.claim_next())
+        Task.objects.filter(pk=task.pk).update(claimed_until=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(tasks.claim_next(), task.pk)
+        task.refresh_from_db()
+        self.assertEqual((task.status, task.attempts), ('running', 2))
+        self.assertIn('stopped before it finished', task.error)
+        self.assertGreater(task.claimed_until, timezone.now())
+
+    def test_cancel_task_with_expired_lease(self):
+        task = tasks.enqueue('test_flaky')
+        tasks.claim_next()
+        Task.objects.filter(pk=task.pk).update(claimed_until=timezone.now() - timedelta(seconds=1))
+        self.assertTrue(tasks.cancel(task))
+        task.refresh_from_db()
+        self.assertEqual(task.status, 'cancelled')
+
+    def test_worker_that_lost_its_lease_does_not_overwrite_the_task(self):
+        cancelled = tasks.enqueue('test_outlives_lease', {'then': 'cancel'})
+        tasks.claim_next()
+        tasks.execute(cancelled.pk)
+        cancelled.refresh_from_db()
+        self.assertEqual((cancelled.status, cancelled.result), ('cancelled', None))
+
+        with override_settings(TASK_RETRY_DELAY_SECONDS=0):
+            reclaimed = tasks.enqueue('test_outlives_lease', {'then': 'reclaim'})
+            tasks.claim_next()
+            tasks.execute(reclaimed.pk)
+        reclaimed.refresh_from_db()
+        self.assertEqual((reclaimed.status, reclaimed.attempts, reclaimed.result), ('running', 2, None))
+        self.assertFalse(tasks.fail(reclaimed.pk, 'late failure', attempt=1))
+        with self.assertRaises(tasks.TaskCancelled):
+            tasks.TaskContext(Task(pk=reclaimed.pk, attempts=1)).set_progress(50)
+
+    def test_interrupted_task_goes_back_to_queue(self):
+        task = tasks.enqueue('test_interrupted')
+        tasks.claim_next()
+        with self.assertRaises(KeyboardInterrupt):
+            tasks.execute(task.pk)
+        task.refresh_from_db()
+        self.assertEqual((task.status, task.attempts, task.claimed_until), ('pending', 0, None))
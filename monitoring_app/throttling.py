@@ -0,0 +1,162 @@
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from rest_framework.permissions import SAFE_METHODS
+from rest_framework.throttling import BaseThrottle
+
+RATE_PERIODS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+# Buckets that have refilled completely carry no state and can be dropped.
+# The store prunes at this size, then again once it has doubled its survivors.
+LOCAL_STORE_PRUNE_SIZE = 10000
+
+
+def take(tokens, updated, now, rate, burst):
+    """
+    Refill a bucket holding ``tokens`` at ``updated`` up to ``now`` and take one
+    token. Returns (tokens, wait) where wait is 0 if the request may proceed,
+    otherwise the seconds until a token is available.
+    """
+    tokens = min(burst, tokens + (now - updated) * rate)
+    if tokens >= 1:
+        return tokens - 1, 0
+    return tokens, (1 - tokens) / rate
+
+
+class LocalBucketStore:
+    """Token buckets in this process's memory; exact, but per worker."""
+
+    def __init__(self):
+        self.buckets = {}
+        self.prune_at = LOCAL_STORE_PRUNE_SIZE
+        self.lock = threading.Lock()
+
+    def consume(self, key, rate, burst):
+        now = time.monotonic()
+        with self.lock:
+            tokens, updated, _ = self.buckets.get(key, (burst, now, now))
+            tokens, wait = take(tokens, updated, now, rate, burst)
+            # Also remember when the bucket will be full again, for pruning.
+            self.buckets[key] = (tokens, now, now + (burst - tokens) / rate)
+            if len(self.buckets) > self.prune_at:
+                self.prune(now)
+        return wait
+
+    def prune(self, now):
+        self.buckets = {key: bucket for key, bucket in self.buckets.items() if bucket[2] > now}
+        # With many live buckets, pruning again on the next request would free
+        # nothing; wait until the store has grown enough to make it worthwhile.
+        self.prune_at = max(LOCAL_STORE_PRUNE_SIZE, 2 * len(self.buckets))
+
+    def clear(self):
+        with self.lock:
+            self.buckets.clear()
+
+
+class CacheBucketStore:
+    """
+    Token buckets in a Django cache shared by all workers. The read-modify-write
+    is not atomic, so concurrent requests may occasionally both get a token.
+    """
+
+    def __init__(self, alias='default'):
+        self.cache = caches[alias]
+
+    def consume(self, key, rate, burst):
+        now = time.time()
+        key = 'throttle-bucket:%s' % key
+        tokens, updated = self.cache.get(key, (burst, now))
+        tokens, wait = take(tokens, updated, now, rate, burst)
+        self.cache.set(key, (tokens, now), timeout=int(burst / rate) + 1)
+        return wait
+
+    def clear(self):
+        pass
+
+
+_store = None
+_config = {}
+
+
+def get_store():
+    global _store
+    if _store is None:
+        if getattr(settings, 'INGEST_THROTTLE_BACKEND', 'local') == 'cache':
+            _store = CacheBucketStore(getattr(settings, 'INGEST_THROTTLE_CACHE', 'default'))
+        else:
+            _store = LocalBucketStore()
+    return _store
+
+
+def get_bucket_config(scope):
+    """(tokens per second, burst) for ``scope``, or None if it isn't throttled."""
+    if scope not in _config:
+        config = getattr(settings, 'INGEST_THROTTLES', {}).get(scope)
+        if config is None:
+            _config[scope] = None
+        else:
+            # Same '<requests>/<period>' format as DRF's DEFAULT_THROTTLE_RATES.
+            num, period = config['rate'].split('/')
+            _config[scope] = int(num) / RATE_PERIODS[period[0]], config.get('burst', int(num))
+    return _config[scope]
+
+
+@receiver(setting_changed)
+def reset_buckets(setting, **kwargs):
+    global _store
+    if setting in ('INGEST_THROTTLES', 'INGEST_THROTTLE_BACKEND', 'INGEST_THROTTLE_CACHE'):
+        _config.clear()
+        if _store is not None:
+            _store.clear()
+        _store = None
+
+
+class TokenBucketThrottle(BaseThrottle):
+    """
+    Throttles unsafe requests with a token bucket per ident: ``rate`` refills
+    the bucket and ``burst`` is its size, both from INGEST_THROTTLES[scope].
+    """
+    scope = None
+
+    def get_ident_key(self, request, view):
+        raise NotImplementedError('.get_ident_key() must be overridden')
+
+    def allow_request(self, request, view):
+        if request.method in SAFE_METHODS:
+            return True
+        config = get_bucket_config(self.scope)
+        if config is None:
+            return True
+        key = self.get_ident_key(request, view)
+        if key is None:
+            return True
+        self.wait_time = get_store().consume('%s:%s' % (self.scope, key), *config)
+        return not self.wait_time
+
+    def wait(self):
+        return self.wait_time
+
+
+class DeviceIngestThrottle(TokenBucketThrottle):
+    scope = 'device'
+
+    def get_ident_key(self, request, view):
+        data = request.data
+        device = data.get('device') if hasattr(data, 'get') else None
+        return None if device in (None, '') else str(device)
+
+
+class TokenIngestThrottle(TokenBucketThrottle):
+    scope = 'token'
+
+    def get_ident_key(self, request, view):
+        key = getattr(request.auth, 'key', None)
+        if key is not None:
+            return key
+        if request.user.is_authenticated:
+            return 'user:%s' % request.user.pk
+        return self.get_ident(request)
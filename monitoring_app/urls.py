@@ -5,9 +5,11 @@ urlpatterns = [
     # Authentication endpoints
     path('auth/register/', views.register_user, name='register'),
     path('auth/login/', views.login_user, name='login'),
+    path('auth/accept-invite/', views.accept_invite, name='accept-invite'),
     
     # Patient endpoints
     path('patients/', views.PatientListCreateView.as_view(), name='patient-list'),
+    path('patients/bulk/', views.bulk_enroll_patients, name='patient-bulk-enroll'),
     path('patients/<int:pk>/', views.PatientDetailView.as_view(), name='patient-detail'),
     
     # Heart rate endpoints
@@ -17,4 +19,15 @@ urlpatterns = [
     # Device endpoints
     path('devices/', views.DeviceListCreateView.as_view(), name='device-list'),
     path('devices/<int:pk>/', views.DeviceDetailView.as_view(), name='device-detail'),
+
+    # Coverage endpoints
+    path('coverage/devices/', views.DeviceCoverageView.as_view(), name='device-coverage'),
+    path('coverage/patients/', views.PatientCoverageView.as_view(), name='patient-coverage'),
+    path('coverage/gaps/', views.CoverageGapsView.as_view(), name='coverage-gaps'),
+
+    # Background task endpoints
+    path('tasks/', views.TaskListCreateView.as_view(), name='task-list'),
+    path('tasks/<int:pk>/', views.TaskDetailView.as_view(), name='task-detail'),
+    path('tasks/<int:pk>/cancel/', views.cancel_task, name='task-cancel'),
+    path('tasks/<int:pk>/download/', views.download_task_file, name='task-download'),
 ]
\ No newline at end of file
@@ -1,13 +1,26 @@
+import os
 from rest_framework import status, permissions, generics, filters
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
 from rest_framework.authtoken.models import Token
 from django_filters.rest_framework import DjangoFilterBackend
+from django.conf import settings
+from django.contrib.auth.tokens import default_token_generator
+from django.db.models import Max
+from django.http import FileResponse, Http404
 from django.utils import timezone
+from django.utils.http import urlsafe_base64_decode
 from datetime import timedelta
-from .models import User, Patient, Device, HeartRateData
+from .models import User, Patient, Device, DeviceCoverageInterval, HeartRateData, Task
 from .serializers import (UserRegistrationSerializer, UserLoginSerializer, 
-                         PatientSerializer, DeviceSerializer, HeartRateDataSerializer)
+                         PatientSerializer, DeviceSerializer, HeartRateDataSerializer,
+                         AcceptInviteSerializer, CoverageWindowSerializer, TaskSerializer)
+from . import coverage, tasks
+from .enrollment import enroll_patients
+from .routers import ReplicaReadMixin, pin_to_primary
+from .search import IndexedSearchFilter
+from .throttling import DeviceIngestThrottle, TokenIngestThrottle
 
 @api_view(['POST'])
 @permission_classes([permissions.AllowAny])
@@ -49,12 +62,53 @@ def login_user(request):
         })
     return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
-class PatientListCreateView(generics.ListCreateAPIView):
+@api_view(['POST'])
+@permission_classes([permissions.IsAdminUser])
+def bulk_enroll_patients(request):
+    rows = request.data
+    if not isinstance(rows, list):
+        return Response({'error': 'Expected a list of patients.'}, status=status.HTTP_400_BAD_REQUEST)
+    max_rows = getattr(settings, 'ENROLLMENT_MAX_ROWS', 5000)
+    if len(rows) > max_rows:
+        return Response({'error': 'At most %d patients per request.' % max_rows},
+                        status=status.HTTP_400_BAD_REQUEST)
+    created, errors = enroll_patients(rows)
+    if created:
+        pin_to_primary(request)
+    return Response({'created': created, 'errors': errors},
+                    status=status.HTTP_201_CREATED if created else status.HTTP_400_BAD_REQUEST)
+
+@api_view(['POST'])
+@permission_classes([permissions.AllowAny])
+def accept_invite(request):
+    serializer = AcceptInviteSerializer(data=request.data)
+    if not serializer.is_valid():
+        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+    try:
+        user = User.objects.get(pk=urlsafe_base64_decode(serializer.validated_data['uid']).decode())
+    except (TypeError, ValueError, OverflowError, User.DoesNotExist):
+        user = None
+    if user is None or not default_token_generator.check_token(user, serializer.validated_data['token']):
+        return Response({'error': 'Invalid or expired invite.'}, status=status.HTTP_400_BAD_REQUEST)
+    user.set_password(serializer.validated_data['password'])
+    user.save()
+    token, created = Token.objects.get_or_create(user=user)
+    pin_to_primary(request, token)
+    return Response({
+        'token': token.key,
+        'user_id': user.pk,
+        'username': user.username,
+        'email': user.email,
+        'user_type': user.user_type
+    })
+
+class PatientListCreateView(ReplicaReadMixin, generics.ListCreateAPIView):
     queryset = Patient.objects.all()
     serializer_class = PatientSerializer
     permission_classes = [permissions.IsAuthenticated]
-    filter_backends = [DjangoFilterBackend, filters.SearchFilter, filters.OrderingFilter]
+    filter_backends = [DjangoFilterBackend, IndexedSearchFilter, filters.OrderingFilter]
     filterset_fields = ['gender']
+    search_index_field = 'search_tokens'
     search_fields = ['user__first_name', 'user__last_name', 'user__username']
     ordering_fields = ['user__first_name', 'user__last_name', 'created_at']
     ordering = ['user__first_name']
@@ -64,7 +118,8 @@ class PatientListCreateView(generics.ListCreateAPIView):
             return [permissions.IsAuthenticated(), permissions.IsAdminUser()]
         return super().get_permissions()
 
-class PatientDetailView(generics.RetrieveUpdateDestroyAPIView):
+class PatientDetailView(ReplicaReadMixin, generics.RetrieveUpdateDestroyAPIView):
+    replica_reads = False
     queryset = Patient.objects.all()
     serializer_class = PatientSerializer
     permission_classes = [permissions.IsAuthenticated]
@@ -74,25 +129,28 @@ class PatientDetailView(generics.RetrieveUpdateDestroyAPIView):
             return [permissions.IsAuthenticated(), permissions.IsAdminUser()]
         return super().get_permissions()
 
-class DeviceListCreateView(generics.ListCreateAPIView):
+class DeviceListCreateView(ReplicaReadMixin, generics.ListCreateAPIView):
     queryset = Device.objects.all()
     serializer_class = DeviceSerializer
     permission_classes = [permissions.IsAuthenticated]
-    filter_backends = [DjangoFilterBackend, filters.SearchFilter]
+    filter_backends = [DjangoFilterBackend, IndexedSearchFilter]
     filterset_fields = ['status', 'patient']
+    search_index_field = 'search_tokens'
     search_fields = ['device_id', 'patient__user__username']
 
-class DeviceDetailView(generics.RetrieveUpdateDestroyAPIView):
+class DeviceDetailView(ReplicaReadMixin, generics.RetrieveUpdateDestroyAPIView):
+    replica_reads = False
     queryset = Device.objects.all()
     serializer_class = DeviceSerializer
     permission_classes = [permissions.IsAuthenticated]
 
-class HeartRateDataListCreateView(generics.ListCreateAPIView):
+class HeartRateDataListCreateView(ReplicaReadMixin, generics.ListCreateAPIView):
     serializer_class = HeartRateDataSerializer
     permission_classes = [permissions.IsAuthenticated]
     filter_backends = [DjangoFilterBackend, filters.OrderingFilter]
     filterset_fields = ['device', 'patient']
     ordering_fields = ['recorded_at', 'created_at', 'heart_rate']
+    throttle_classes = [DeviceIngestThrottle, TokenIngestThrottle]
     ordering = ['-recorded_at']
     
     def get_queryset(self):
@@ -112,7 +170,7 @@ class HeartRateDataListCreateView(generics.ListCreateAPIView):
             # The serializer validation will handle the required patient field
             serializer.save()
 
-class PatientHeartRateStatsView(generics.GenericAPIView):
+class PatientHeartRateStatsView(ReplicaReadMixin, generics.GenericAPIView):
     permission_classes = [permissions.IsAuthenticated]
     
     def get(self, request, *args, **kwargs):
@@ -156,4 +214,154 @@ class PatientHeartRateStatsView(generics.GenericAPIView):
             'today': calculate_stats(today_data),
         }
         
-        return Response(stats)
\ No newline at end of file
+        return Response(stats)
+
+class CoverageView(ReplicaReadMixin, generics.GenericAPIView):
+    """Base for the coverage endpoints, answered from the coverage interval index."""
+    permission_classes = [permissions.IsAdminUser]
+    filter_backends = [DjangoFilterBackend]
+
+    def get_window(self, request):
+        serializer = CoverageWindowSerializer(data=request.query_params)
+        serializer.is_valid(raise_exception=True)
+        return serializer.validated_data
+
+class DeviceCoverageView(CoverageView):
+    queryset = Device.objects.order_by('pk')
+    filterset_fields = ['status', 'patient']
+
+    def get(self, request, *args, **kwargs):
+        window = self.get_window(request)
+        devices = self.paginate_queryset(self.filter_queryset(self.get_queryset()))
+        device_ids = [device.pk for device in devices]
+        intervals = coverage.intervals_by('device', device_ids, window['start'], window['end'])
+        # Aggregated for this page only, rather than annotated on the queryset
+        # where it would group every filtered device before paginating.
+        last_seen = dict(DeviceCoverageInterval.objects.filter(device_id__in=device_ids).order_by()
+                         .values('device').annotate(last_seen=Max('end')).values_list('device', 'last_seen'))
+        results = []
+        for device in devices:
+            covered, percent = coverage.coverage(intervals[device.pk], window['start'], window['end'])
+            results.append({
+                'device': device.pk,
+                'device_id': device.device_id,
+                'patient': device.patient_id,
+                'covered_seconds': covered,
+                'coverage_percent': percent,
+                'last_seen': last_seen.get(device.pk),
+            })
+        return self.get_paginated_response(results)
+
+class PatientCoverageView(CoverageView):
+    queryset = Patient.objects.order_by('pk')
+    filterset_fields = ['gender']
+
+    def get(self, request, *args, **kwargs):
+        window = self.get_window(request)
+        patients = self.paginate_queryset(self.filter_queryset(self.get_queryset()))
+        intervals = coverage.intervals_by('patient', [patient.pk for patient in patients], window['start'], window['end'])
+        results = []
+        for patient in patients:
+            covered, percent = coverage.coverage(intervals[patient.pk], window['start'], window['end'])
+            results.append({
+                'patient': patient.pk,
+                'covered_seconds': covered,
+                'coverage_percent': percent,
+            })
+        return self.get_paginated_response(results)
+
+class CoverageGapsView(CoverageView):
+    """
+    Devices with gaps of at least ``min_gap`` seconds in the window. Devices are
+    scanned in id order and skipped when they have no gaps, so each page holds
+    up to page_size devices with gaps; ``next`` continues the scan with
+    ``after``. A request scans at most ``max_scan`` devices, so a page can come
+    back short (with a ``next``) when gaps are rare.
+    """
+    queryset = Device.objects.order_by('pk')
+    filterset_fields = ['status', 'patient']
+    scan_batch_size = 500
+    max_scan = 20000
+
+    def get(self, request, *args, **kwargs):
+        window = self.get_window(request)
+        min_gap = timedelta(seconds=window['min_gap']) if 'min_gap' in window else coverage.max_gap()
+        page_size = self.paginator.get_page_size(request)
+        devices = self.filter_queryset(self.get_queryset())
+        cursor = window.get('after', 0)
+        results = []
+        scanned = 0
+        exhausted = False
+        while len(results) < page_size and scanned < self.max_scan:
+            batch = list(devices.filter(pk__gt=cursor)[:self.scan_batch_size])
+            intervals = coverage.intervals_by('device', [device.pk for device in batch],
+                                              window['start'], window['end'])
+            for device in batch:
+                cursor = device.pk
+                scanned += 1
+                gaps = coverage.gaps(intervals[device.pk], window['start'], window['end'], min_gap)
+                if gaps:
+                    results.append({
+                        'device': device.pk,
+                        'device_id': device.device_id,
+                        'patient': device.patient_id,
+                        'gaps': [
+                            {'start': start, 'end': end, 'seconds': (end - start).total_seconds()}
+                            for start, end in gaps
+                        ],
+                    })
+                    if len(results) == page_size:
+                        break
+            else:
+                if len(batch) < self.scan_batch_size:
+                    exhausted = True
+                    break
+        next_url = None
+        if not exhausted:
+            next_url = replace_query_param(request.build_absolute_uri(), 'after', cursor)
+        return Response({'next': next_url, 'results': results})
+
+
+class TaskListCreateView(generics.ListCreateAPIView):
+    queryset = Task.objects.all()
+    serializer_class = TaskSerializer
+    permission_classes = [permissions.IsAdminUser]
+    filter_backends = [DjangoFilterBackend, filters.OrderingFilter]
+    filterset_fields = ['name', 'status']
+    ordering_fields = ['created_at', 'run_after']
+
+    def perform_create(self, serializer):
+        data = serializer.validated_data
+        serializer.instance = tasks.enqueue(data['name'], data.get('arguments'), self.request.user,
+                                            data.get('max_retries'))
+
+class TaskDetailView(generics.RetrieveAPIView):
+    queryset = Task.objects.all()
+    serializer_class = TaskSerializer
+    permission_classes = [permissions.IsAdminUser]
+
+@api_view(['POST'])
+@permission_classes([permissions.IsAdminUser])
+def cancel_task(request, pk):
+    try:
+        task = Task.objects.get(pk=pk)
+    except Task.DoesNotExist:
+        return Response({"error": "Task not found."}, status=status.HTTP_404_NOT_FOUND)
+    if not tasks.cancel(task):
+        return Response({"error": "Task has already finished."}, status=status.HTTP_400_BAD_REQUEST)
+    task.refresh_from_db()
+    return Response(TaskSerializer(task).data)
+
+@api_view(['GET'])
+@permission_classes([permissions.IsAdminUser])
+def download_task_file(request, pk):
+    task = Task.objects.filter(pk=pk, status='succeeded').first()
+    file_name = (task.result or {}).get('file') if task else None
+    if not file_name:
+        raise Http404("No file for this task.")
+    export_dir = getattr(settings, 'TASK_EXPORT_DIR', settings.BASE_DIR / 'exports')
+    try:
+        export = open(os.path.join(export_dir, os.path.basename(file_name)), 'rb')
+    except FileNotFoundError:
+        raise Http404("The file for this task no longer exists.")
+    return FileResponse(export, as_attachment=True, filename=file_name)
@@ -53,12 +53,103 @@ TEMPLATES = [
 
 WSGI_APPLICATION = 'patient_monitoring.wsgi.application'
 
+# Seconds to keep database connections open between requests (0 closes them
+# after every request).
+DB_CONN_MAX_AGE = int(os.environ.get('DB_CONN_MAX_AGE', '60'))
+
+DB_ENGINE = os.environ.get('DB_ENGINE', 'django.db.backends.sqlite3')
+
+
+def database(location):
+    """SQLite takes a file name, other engines a host[:port]."""
+    config = {
+        'ENGINE': DB_ENGINE,
+        'CONN_MAX_AGE': DB_CONN_MAX_AGE,
+        'CONN_HEALTH_CHECKS': True,
+    }
+    if DB_ENGINE.endswith('sqlite3'):
+        config['NAME'] = BASE_DIR / location
+        # Wait for other processes' write transactions (e.g. task workers).
+        config['OPTIONS'] = {'timeout': 30}
+    else:
+        host, _, port = location.partition(':')
+        config.update({
+            'NAME': os.environ.get('DB_NAME', 'patient_monitoring'),
+            'USER': os.environ.get('DB_USER', ''),
+            'PASSWORD': os.environ.get('DB_PASSWORD', ''),
+            'HOST': host,
+            'PORT': port,
+        })
+    return config
+
+
 DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+    'default': database(os.environ.get('DB_PRIMARY', 'db.sqlite3' if DB_ENGINE.endswith('sqlite3') else 'localhost')),
+}
+
+# Read replicas as a comma separated list of locations, e.g.
+# DB_REPLICAS=replica1.sqlite3,replica2.sqlite3 or DB_REPLICAS=localhost:5433
+DATABASE_READ_REPLICAS = []
+for index, location in enumerate(filter(None, os.environ.get('DB_REPLICAS', '').split(',')), start=1):
+    alias = 'replica%d' % index
+    DATABASES[alias] = database(location.strip())
+    DATABASES[alias]['TEST'] = {'MIRROR': 'default'}
+    DATABASE_READ_REPLICAS.append(alias)
+
+DATABASE_ROUTERS = ['monitoring_app.routers.PrimaryReplicaRouter']
+
+# How long a client's reads stay on the primary after it writes. The pin is
+# stored in PRIMARY_PIN_CACHE, which must be shared by every web worker (e.g.
+# CACHE_URL=redis://localhost:6379/0) or a client's next read may land on a
+# worker that never saw the write.
+REPLICATION_LAG_SECONDS = int(os.environ.get('REPLICATION_LAG_SECONDS', '5'))
+PRIMARY_PIN_CACHE = 'default'
+
+CACHES = {
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+}
+if os.environ.get('CACHE_URL'):
+    CACHES['default'] = {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': os.environ['CACHE_URL'],
     }
+
+# Answer patient/device searches from the token index; turn off to fall back
+# to DRF's icontains search.
+SEARCH_INDEX_ENABLED = True
+
+# Filtered admin changelists stop counting at this many rows.
+ADMIN_COUNT_LIMIT = 10000
+
+# Bulk patient enrollment: rows per request, and the process pool used to hash
+# passwords once a batch has at least ENROLLMENT_POOL_THRESHOLD of them.
+ENROLLMENT_MAX_ROWS = 5000
+ENROLLMENT_HASH_WORKERS = os.cpu_count() or 1
+ENROLLMENT_POOL_THRESHOLD = 16
+
+# Token bucket limits for POSTs to heart-rate/: 'rate' refills the bucket and
+# 'burst' is its size. The 'local' backend keeps buckets in each worker's
+# memory; 'cache' shares them through INGEST_THROTTLE_CACHE across workers.
+INGEST_THROTTLES = {
+    'device': {'rate': '2/s', 'burst': 60},
+    'token': {'rate': '20/s', 'burst': 600},
 }
+INGEST_THROTTLE_BACKEND = 'local'
+INGEST_THROTTLE_CACHE = 'default'
+
+# Readings from one device further apart than this count as a gap in coverage.
+COVERAGE_MAX_GAP_SECONDS = 300
+
+# Background tasks (manage.py run_workers): worker processes, retries with
+# exponential backoff starting at TASK_RETRY_DELAY_SECONDS, and where exports
+# are written. run_workers renews the lease of each task it runs; a running
+# task whose lease is TASK_LEASE_SECONDS old has lost its worker and is
+# retried. With --processes 0 leases are only renewed by progress reports.
+TASK_WORKERS = os.cpu_count() or 1
+TASK_MAX_RETRIES = 3
+TASK_RETRY_DELAY_SECONDS = 30
+TASK_LEASE_SECONDS = 300
+TASK_EXPORT_DIR = BASE_DIR / 'exports'
 
 AUTH_PASSWORD_VALIDATORS = [
     {